@@ -371,7 +371,9 @@ namespace AES {
                 state.copy_to(it);
             }
             // As we use PKCS#7, we know lenght of padding - value of last byte
-            res.resize(res.size() - res.back());
+            // (not valid padding if chifertext was cut to the length of block-aligned text)
+            if (!res.empty() && res.back() > 0 && res.back() <= BLOCK_LEN)
+                res.resize(res.size() - res.back());
             return res;
         }
     };
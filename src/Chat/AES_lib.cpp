@@ -1,7 +1,12 @@
+#ifdef _WIN32
 #define DLL_EXPORT __declspec(dllexport)   
 #define WIN32_LEAN_AND_MEAN
 
 #include <windows.h>
+#else
+#define DLL_EXPORT
+#define WINAPI
+#endif
 
 #include "../AES.cpp"
 
@@ -19,10 +24,11 @@ extern "C" {
         std::copy(chifertext.begin(), chifertext.end(), res);
     }
     
-    void DLL_EXPORT WINAPI AES128_decrypt(AES::AES128* self, char *data, size_t len, char *res){
+    size_t DLL_EXPORT WINAPI AES128_decrypt(AES::AES128* self, char *data, size_t len, char *res){
         std::vector<unsigned char> chifertext(data, data + len);
         std::vector<unsigned char> text = self->decrypt(chifertext);
         std::copy(text.begin(), text.end(), res);
+        return text.size();
     }
 
     void DLL_EXPORT WINAPI AES128_delete(AES::AES128* self){
@@ -1,15 +1,32 @@
 import ctypes as C
+import os
 
 from random import randint
 
+import metrics
+
+from AES_py import AES_KEY_LEN, AES_BLOCK_LEN, TableAES128, NumpyAES128, chifertext_len, encrypt_buffer_len
 
-try:
-    lib = C.CDLL('.\\AES_lib.dll', winmode=0x8)
-except FileNotFoundError:
-    lib = C.CDLL('.\\src\\Chat\\AES_lib.dll', winmode=0x8)
 
-AES_KEY_LEN = 16
-AES_BLOCK_LEN = 16
+def _load_native():
+    '''
+        Load compiled AES_lib (AES_lib.dll on Windows, libAES_lib.so elsewhere) from the current
+        directory or next to this file. Return None if it is not built
+    '''
+    name = 'AES_lib.dll' if os.name == 'nt' else 'libAES_lib.so'
+    for directory in ('.', os.path.join('src', 'Chat'), os.path.dirname(os.path.abspath(__file__))):
+        path = os.path.abspath(os.path.join(directory, name))
+        if not os.path.exists(path):
+            continue
+        try:
+            if os.name == 'nt':
+                return C.CDLL(path, winmode=0x8)
+            return C.CDLL(path)
+        except OSError:
+            continue
+    return None
+
+lib = _load_native()
 
 def gen_key(key = None):
     '''
@@ -21,9 +38,27 @@ def gen_key(key = None):
         res[i] = (randint(0, 255) if key == None else key[i])
     return res
 
+def _in_pointer(buffer):
+    '''
+        Argument for read-only data: bytes are passed as is, writable buffers
+        (bytearray, memoryview, mmap) by pointer without copying
+    '''
+    if isinstance(buffer, bytes):
+        return buffer
+    view = memoryview(buffer).cast('B')
+    if view.readonly:
+        return bytes(view)
+    return (C.c_char * len(view)).from_buffer(view)
+
+def _out_pointer(buffer):
+    view = memoryview(buffer).cast('B')
+    return (C.c_char * len(view)).from_buffer(view)
+
 
-class AES128(object):
+class NativeAES128(object):
     def __init__(self, key):
+        if not isinstance(key, C.Array):
+            key = gen_key(key)
         ctor = lib.AES128_new
         ctor.restype = C.c_void_p
         ctor.argtypes = [C.POINTER(C.c_ubyte)]
@@ -31,12 +66,12 @@ class AES128(object):
 
         fun = lib.AES128_encrypt
         fun.restype = None
-        fun.argtypes = [C.c_void_p, C.c_char_p, C.c_size_t, C.c_char_p]
+        fun.argtypes = [C.c_void_p, C.c_void_p, C.c_size_t, C.c_void_p]
         self.enc = fun
 
         fun = lib.AES128_decrypt
-        fun.restype = None
-        fun.argtypes = [C.c_void_p, C.c_char_p, C.c_size_t, C.c_char_p]
+        fun.restype = C.c_size_t # length of text without padding
+        fun.argtypes = [C.c_void_p, C.c_void_p, C.c_size_t, C.c_void_p]
         self.dec = fun
 
         fun = lib.AES128_delete
@@ -50,18 +85,116 @@ class AES128(object):
         """
         text_len = len(text)
         chifertext_len = ((text_len + AES_BLOCK_LEN - 1) // AES_BLOCK_LEN) * AES_BLOCK_LEN
-        res = C.create_string_buffer(chifertext_len)
+        # library always writes a whole PKCS#7 padding, one block more for aligned text
+        res = C.create_string_buffer((text_len // AES_BLOCK_LEN + 1) * AES_BLOCK_LEN)
         self.enc(self.obj, text, text_len, res)
-        return res.raw
-    
+        return res.raw[:chifertext_len]
+
     def decrypt(self, chifertext):
         """
             chifertext - bytes object to  decrypt
         """
         chifertext_len = len(chifertext)
-        res = C.create_string_buffer(len(chifertext))
+        if chifertext_len == 0: # library reads the last byte for padding length
+            return b''
+        res = C.create_string_buffer(-(-chifertext_len // AES_BLOCK_LEN) * AES_BLOCK_LEN)
         self.dec(self.obj, chifertext, chifertext_len, res)
-        return res.raw
+        return res.raw[:chifertext_len]
+
+    def encrypt_into(self, src, dst):
+        """
+            Encrypt buffer src into writable buffer dst of at least encrypt_buffer_len(len(src)) bytes
+            Return length of chifertext as encrypt() gives it. dst[:encrypt_buffer_len(len(src))]
+            always holds the whole PKCS#7 chifertext, which decrypts back exactly
+        """
+        text_len = memoryview(src).nbytes
+        if memoryview(dst).nbytes < encrypt_buffer_len(text_len):
+            raise ValueError("destination buffer is too small")
+        self.enc(self.obj, _in_pointer(src), text_len, _out_pointer(dst))
+        return chifertext_len(text_len)
+
+    def decrypt_into(self, src, dst):
+        """
+            Decrypt buffer src into writable buffer dst of at least chifertext_len(len(src)) bytes
+            Return length of plaintext without PKCS#7 padding, it is followed by zeros up to len(src).
+            Only the whole chifertext of encrypt_into always gives the exact length
+        """
+        length = memoryview(src).nbytes
+        if memoryview(dst).nbytes < chifertext_len(length):
+            raise ValueError("destination buffer is too small")
+        if length == 0:
+            return 0
+        res = _out_pointer(dst)
+        C.memset(res, 0, length)
+        return self.dec(self.obj, _in_pointer(src), length, res)
 
     def __del__(self):
-        self.delet(self.obj)
\ No newline at end of file
+        self.delet(self.obj)
+
+
+# Available implementations, all with the same AES128(key).encrypt/decrypt contract.
+# The first one is used unless AES_BACKEND environment variable names another
+BACKENDS = {}
+if lib is not None:
+    BACKENDS['native'] = NativeAES128
+try:
+    import numpy
+    BACKENDS['numpy'] = NumpyAES128
+except ImportError:
+    pass
+BACKENDS['table'] = TableAES128
+
+backend = os.environ.get('AES_BACKEND') or next(iter(BACKENDS))
+AES128 = metrics.instrument(BACKENDS[backend], "aes", ("encrypt", "decrypt", "encrypt_into", "decrypt_into"))
+
+
+def benchmark(sizes=(1 << 10, 1 << 16, 1 << 20, 1 << 26), time_limit=5.0):
+    '''
+        Print encrypt/decrypt throughput of every available backend.
+        Larger sizes are skipped for a backend once they are expected to take over time_limit seconds
+    '''
+    import time
+    key = gen_key()
+    for name, cls in BACKENDS.items():
+        aes = cls(key)
+        for i, size in enumerate(sizes):
+            data = os.urandom(size)
+            start = time.perf_counter()
+            chifertext = aes.encrypt(data)
+            enc_time = time.perf_counter() - start
+            start = time.perf_counter()
+            aes.decrypt(chifertext)
+            dec_time = time.perf_counter() - start
+            print(f"{name:>6} {size:>9} B: encrypt {size/enc_time/2**20:9.3f} MiB/s, decrypt {size/dec_time/2**20:9.3f} MiB/s")
+            if i+1 < len(sizes) and (enc_time + dec_time) * sizes[i+1] / size > time_limit:
+                break
+
+def tests():
+    key = gen_key()
+    messages = [b'', b'a', "Олег is the best)".encode(), bytes(range(16)) + b'!', os.urandom(1000)]
+    reference = BACKENDS['table'](key)
+    for name, cls in BACKENDS.items():
+        aes = cls(key)
+        for m in messages:
+            chifertext = aes.encrypt(m)
+            assert chifertext == reference.encrypt(m), f'{name} encrypt {len(m)}'
+            assert aes.decrypt(chifertext) == m.ljust(len(chifertext), b'\0'), f'{name} decrypt {len(m)}'
+            frame = bytearray(encrypt_buffer_len(len(m)))
+            assert aes.encrypt_into(memoryview(m), frame) == len(chifertext), f'{name} encrypt_into {len(m)}'
+            assert frame[:len(chifertext)] == chifertext, f'{name} encrypt_into {len(m)}'
+            text = bytearray(len(chifertext))
+            aes.decrypt_into(memoryview(frame)[:len(chifertext)], text)
+            assert text == m.ljust(len(chifertext), b'\0'), f'{name} decrypt_into {len(m)}'
+        # whole PKCS#7 chifertext gives exact length, also for aligned text ending with padding-like byte
+        for m in messages + [b'fifteen chars\0\0\x03']:
+            frame = bytearray(encrypt_buffer_len(len(m)))
+            aes.encrypt_into(m, frame)
+            text = bytearray(len(frame))
+            assert aes.decrypt_into(frame, text) == len(m) and text[:len(m)] == m, f'{name} decrypt_into {len(m)}'
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()
@@ -0,0 +1,240 @@
+'''
+    Pure Python AES-128 backends, byte-compatible with AES_lib.dll:
+    CBC mode with zero IV, PKCS#7 padding, output cut to whole blocks of the input
+'''
+
+AES_KEY_LEN = 16
+AES_BLOCK_LEN = 16
+
+def _mul(a, b):
+    # multiplication in GF(2^8) under x^8 + x^4 + x^3 + x + 1
+    res = 0
+    while b:
+        if b & 1:
+            res ^= a
+        a = ((a << 1) ^ 0x11B) if a & 0x80 else (a << 1)
+        b >>= 1
+    return res
+
+def _gen_tables():
+    '''
+        Return (S_BOX, INV_S_BOX, Te, Td), where Te[k], Td[k] are 256-entry tables of
+        32-bit big-endian words combining SubBytes and (Inv)MixColumns for row k
+    '''
+    s_box = [0]*256
+    for x in range(256):
+        inverse = next((y for y in range(1, 256) if _mul(x, y) == 1), 0)
+        res = 0x63
+        for i in range(5): # affine transform: b ^ rotl(b,1) ^ ... ^ rotl(b,4) ^ 0x63
+            res ^= ((inverse << i) | (inverse >> (8 - i))) & 0xFF
+        s_box[x] = res
+    inv_s_box = [0]*256
+    for x, y in enumerate(s_box):
+        inv_s_box[y] = x
+
+    ror8 = lambda w: ((w >> 8) | (w << 24)) & 0xFFFFFFFF
+    te0 = [(_mul(s, 2) << 24) | (s << 16) | (s << 8) | _mul(s, 3) for s in s_box]
+    td0 = [(_mul(s, 14) << 24) | (_mul(s, 9) << 16) | (_mul(s, 13) << 8) | _mul(s, 11) for s in inv_s_box]
+    Te, Td = [te0], [td0]
+    for _ in range(3):
+        Te.append([ror8(w) for w in Te[-1]])
+        Td.append([ror8(w) for w in Td[-1]])
+    return tuple(s_box), tuple(inv_s_box), tuple(map(tuple, Te)), tuple(map(tuple, Td))
+
+S_BOX, INV_S_BOX, _TE, _TD = _gen_tables()
+
+def _expand_key(key):
+    '''
+        Return (encryption round keys, decryption round keys), 44 words each.
+        Decryption keys are in reverse order with InvMixColumns applied (equivalent inverse cipher)
+    '''
+    w = [int.from_bytes(bytes(key[4*i:4*i+4]), 'big') for i in range(4)]
+    rcon = 1
+    for i in range(4, 44):
+        t = w[i-1]
+        if i % 4 == 0:
+            t = ((t << 8) | (t >> 24)) & 0xFFFFFFFF # RotWord
+            t = (S_BOX[t >> 24] << 24) | (S_BOX[(t >> 16) & 255] << 16) | (S_BOX[(t >> 8) & 255] << 8) | S_BOX[t & 255]
+            t ^= rcon << 24
+            rcon = _mul(rcon, 2)
+        w.append(w[i-4] ^ t)
+
+    Td0, Td1, Td2, Td3 = _TD
+    dw = []
+    for r in range(10, -1, -1):
+        for c in range(4):
+            t = w[4*r + c]
+            if 0 < r < 10:
+                t = Td0[S_BOX[t >> 24]] ^ Td1[S_BOX[(t >> 16) & 255]] ^ Td2[S_BOX[(t >> 8) & 255]] ^ Td3[S_BOX[t & 255]]
+            dw.append(t)
+    return w, dw
+
+def chifertext_len(text_len):
+    # length of encrypt() result: text rounded up to whole blocks
+    return -(-text_len // AES_BLOCK_LEN) * AES_BLOCK_LEN
+
+def encrypt_buffer_len(text_len):
+    # required size of encrypt_into() destination: room for the whole PKCS#7 padding block
+    return (text_len // AES_BLOCK_LEN + 1) * AES_BLOCK_LEN
+
+def _byte_view(buffer):
+    return memoryview(buffer).cast('B')
+
+def _pad(text):
+    # PKCS#7, always adds padding
+    pad = AES_BLOCK_LEN - len(text) % AES_BLOCK_LEN
+    return bytes(text) + bytes([pad]) * pad
+
+def _unpad_into(text, dst, length):
+    '''
+        Write text without PKCS#7 padding to dst and fill the rest up to length with zeros,
+        as AES_lib.dll does. If last byte is not valid padding (input was block-aligned), copy as is.
+        Return length of text written
+    '''
+    pad = int(text[-1]) if len(text) else 0
+    text_len = len(text) - pad if 0 < pad <= AES_BLOCK_LEN else len(text)
+    text_len = min(text_len, length)
+    dst[:text_len] = text[:text_len]
+    dst[text_len:length] = bytes(length - text_len)
+    return text_len
+
+class TableAES128(object):
+    '''
+        AES-128 on 32-bit T-tables, one block at a time
+    '''
+    def __init__(self, key):
+        self._ek, self._dk = _expand_key(key)
+
+    def _encrypt_block(self, s0, s1, s2, s3):
+        Te0, Te1, Te2, Te3 = _TE
+        rk = self._ek
+        s0 ^= rk[0]; s1 ^= rk[1]; s2 ^= rk[2]; s3 ^= rk[3]
+        for r in range(4, 40, 4):
+            t0 = Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 255] ^ Te2[(s2 >> 8) & 255] ^ Te3[s3 & 255] ^ rk[r]
+            t1 = Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 255] ^ Te2[(s3 >> 8) & 255] ^ Te3[s0 & 255] ^ rk[r+1]
+            t2 = Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 255] ^ Te2[(s0 >> 8) & 255] ^ Te3[s1 & 255] ^ rk[r+2]
+            t3 = Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 255] ^ Te2[(s1 >> 8) & 255] ^ Te3[s2 & 255] ^ rk[r+3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        S = S_BOX
+        return ((S[s0 >> 24] << 24 | S[(s1 >> 16) & 255] << 16 | S[(s2 >> 8) & 255] << 8 | S[s3 & 255]) ^ rk[40],
+                (S[s1 >> 24] << 24 | S[(s2 >> 16) & 255] << 16 | S[(s3 >> 8) & 255] << 8 | S[s0 & 255]) ^ rk[41],
+                (S[s2 >> 24] << 24 | S[(s3 >> 16) & 255] << 16 | S[(s0 >> 8) & 255] << 8 | S[s1 & 255]) ^ rk[42],
+                (S[s3 >> 24] << 24 | S[(s0 >> 16) & 255] << 16 | S[(s1 >> 8) & 255] << 8 | S[s2 & 255]) ^ rk[43])
+
+    def _decrypt_block(self, s0, s1, s2, s3):
+        Td0, Td1, Td2, Td3 = _TD
+        rk = self._dk
+        s0 ^= rk[0]; s1 ^= rk[1]; s2 ^= rk[2]; s3 ^= rk[3]
+        for r in range(4, 40, 4):
+            t0 = Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 255] ^ Td2[(s2 >> 8) & 255] ^ Td3[s1 & 255] ^ rk[r]
+            t1 = Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 255] ^ Td2[(s3 >> 8) & 255] ^ Td3[s2 & 255] ^ rk[r+1]
+            t2 = Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 255] ^ Td2[(s0 >> 8) & 255] ^ Td3[s3 & 255] ^ rk[r+2]
+            t3 = Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 255] ^ Td2[(s1 >> 8) & 255] ^ Td3[s0 & 255] ^ rk[r+3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        S = INV_S_BOX
+        return ((S[s0 >> 24] << 24 | S[(s3 >> 16) & 255] << 16 | S[(s2 >> 8) & 255] << 8 | S[s1 & 255]) ^ rk[40],
+                (S[s1 >> 24] << 24 | S[(s0 >> 16) & 255] << 16 | S[(s3 >> 8) & 255] << 8 | S[s2 & 255]) ^ rk[41],
+                (S[s2 >> 24] << 24 | S[(s1 >> 16) & 255] << 16 | S[(s0 >> 8) & 255] << 8 | S[s3 & 255]) ^ rk[42],
+                (S[s3 >> 24] << 24 | S[(s2 >> 16) & 255] << 16 | S[(s1 >> 8) & 255] << 8 | S[s0 & 255]) ^ rk[43])
+
+    def encrypt(self, text):
+        """
+            text - bytes object only
+        """
+        res = bytearray(encrypt_buffer_len(len(text)))
+        return bytes(res[:self.encrypt_into(text, res)])
+
+    def decrypt(self, chifertext):
+        """
+            chifertext - bytes object to  decrypt
+        """
+        res = bytearray(chifertext_len(len(chifertext)))
+        self.decrypt_into(chifertext, res)
+        return bytes(res[:len(chifertext)])
+
+    def encrypt_into(self, src, dst):
+        """
+            Encrypt buffer src into writable buffer dst of at least encrypt_buffer_len(len(src)) bytes
+            Return length of chifertext as encrypt() gives it. dst[:encrypt_buffer_len(len(src))]
+            always holds the whole PKCS#7 chifertext, which decrypts back exactly
+        """
+        src, dst = _byte_view(src), _byte_view(dst)
+        text_len = len(src)
+        if len(dst) < encrypt_buffer_len(text_len):
+            raise ValueError("destination buffer is too small")
+        data = _pad(src)
+        c0 = c1 = c2 = c3 = 0 # zero IV
+        for pos in range(0, len(data), AES_BLOCK_LEN):
+            c0, c1, c2, c3 = self._encrypt_block(
+                int.from_bytes(data[pos:pos+4], 'big') ^ c0, int.from_bytes(data[pos+4:pos+8], 'big') ^ c1,
+                int.from_bytes(data[pos+8:pos+12], 'big') ^ c2, int.from_bytes(data[pos+12:pos+16], 'big') ^ c3)
+            dst[pos:pos+16] = ((c0 << 96) | (c1 << 64) | (c2 << 32) | c3).to_bytes(16, 'big')
+        return chifertext_len(text_len)
+
+    def decrypt_into(self, src, dst):
+        """
+            Decrypt buffer src into writable buffer dst of at least chifertext_len(len(src)) bytes
+            Return length of plaintext without PKCS#7 padding, it is followed by zeros up to len(src)
+        """
+        src, dst = _byte_view(src), _byte_view(dst)
+        length = len(src)
+        if len(dst) < chifertext_len(length):
+            raise ValueError("destination buffer is too small")
+        data = bytes(src).ljust(chifertext_len(length), b'\0')
+        res = bytearray(len(data))
+        p0 = p1 = p2 = p3 = 0 # zero IV
+        for pos in range(0, len(data), AES_BLOCK_LEN):
+            c0, c1, c2, c3 = (int.from_bytes(data[pos+i:pos+i+4], 'big') for i in range(0, 16, 4))
+            t0, t1, t2, t3 = self._decrypt_block(c0, c1, c2, c3)
+            res[pos:pos+16] = (((t0 ^ p0) << 96) | ((t1 ^ p1) << 64) | ((t2 ^ p2) << 32) | (t3 ^ p3)).to_bytes(16, 'big')
+            p0, p1, p2, p3 = c0, c1, c2, c3
+        return _unpad_into(res, dst, length)
+
+class NumpyAES128(TableAES128):
+    '''
+        AES-128 on T-tables held in NumPy arrays.
+        CBC decryption has no dependency between blocks, so all blocks of a message are decrypted
+        as one (n, 4) uint32 array. CBC encryption chains every block on the previous one
+        and stays on the scalar T-table path
+    '''
+    def __init__(self, key):
+        import numpy as np
+        super().__init__(key)
+        self._np = np
+        self._np_dk = np.array(self._dk, dtype=np.uint32).reshape(11, 4)
+        self._np_td = np.array(_TD, dtype=np.uint32)
+        self._np_inv_s_box = np.array(INV_S_BOX, dtype=np.uint32)
+
+    def decrypt_into(self, src, dst):
+        """
+            Decrypt buffer src into writable buffer dst of at least chifertext_len(len(src)) bytes
+            Return length of plaintext without PKCS#7 padding, it is followed by zeros up to len(src)
+        """
+        np = self._np
+        src, dst = _byte_view(src), _byte_view(dst)
+        length = len(src)
+        if len(dst) < chifertext_len(length):
+            raise ValueError("destination buffer is too small")
+        if length == 0:
+            return 0
+        data = src if length % AES_BLOCK_LEN == 0 else bytes(src).ljust(chifertext_len(length), b'\0')
+        blocks = np.frombuffer(data, dtype='>u4').reshape(-1, 4).astype(np.uint32)
+
+        Td0, Td1, Td2, Td3 = self._np_td
+        rk = self._np_dk
+        s0, s1, s2, s3 = (blocks[:, i] ^ rk[0, i] for i in range(4))
+        for r in range(1, 10):
+            s0, s1, s2, s3 = (
+                Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 255] ^ Td2[(s2 >> 8) & 255] ^ Td3[s1 & 255] ^ rk[r, 0],
+                Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 255] ^ Td2[(s3 >> 8) & 255] ^ Td3[s2 & 255] ^ rk[r, 1],
+                Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 255] ^ Td2[(s0 >> 8) & 255] ^ Td3[s3 & 255] ^ rk[r, 2],
+                Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 255] ^ Td2[(s1 >> 8) & 255] ^ Td3[s0 & 255] ^ rk[r, 3])
+        S = self._np_inv_s_box
+        out = np.stack((
+            (S[s0 >> 24] << 24 | S[(s3 >> 16) & 255] << 16 | S[(s2 >> 8) & 255] << 8 | S[s1 & 255]) ^ rk[10, 0],
+            (S[s1 >> 24] << 24 | S[(s0 >> 16) & 255] << 16 | S[(s3 >> 8) & 255] << 8 | S[s2 & 255]) ^ rk[10, 1],
+            (S[s2 >> 24] << 24 | S[(s1 >> 16) & 255] << 16 | S[(s0 >> 8) & 255] << 8 | S[s3 & 255]) ^ rk[10, 2],
+            (S[s3 >> 24] << 24 | S[(s2 >> 16) & 255] << 16 | S[(s1 >> 8) & 255] << 8 | S[s0 & 255]) ^ rk[10, 3]),
+            axis=1)
+        out[1:] ^= blocks[:-1] # CBC chaining, first block is XORed with zero IV
+        return _unpad_into(out.astype('>u4').reshape(-1).view(np.uint8), dst, length)
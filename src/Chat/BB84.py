@@ -1,5 +1,12 @@
+import struct
+
 from random import random, randint, choices
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 rect_basis = '+'
 diag_basis = 'X'
 
@@ -68,7 +75,173 @@ class BB84_User:
         self.key = [x for i, x in enumerate(self.key) if not chosen_compare[i]]
         return True
 
+
+
+# Array form used by NumpyBB84_User: basis 0 = rect, 1 = diag; state = 2*basis + bit,
+# so 0 = →, 1 = ↑, 2 = ↗, 3 = ↖. Functions below convert it to the text of BB84_User and back
+_STATE_CHARS = arrow_ri + arrow_up + arrow_ru + arrow_lu
+
+def bases_to_str(bases) -> str:
+    return np.where(bases, ord(diag_basis), ord(rect_basis)).astype(np.uint8).tobytes().decode('ascii')
+
+def bases_from_str(s: str):
+    return (np.frombuffer(s.encode('ascii'), np.uint8) == ord(diag_basis)).view(np.uint8)
+
+def states_to_str(states) -> str:
+    # arrows are 3 bytes in utf-8, so whole string is built by one table lookup
+    table = np.frombuffer(_STATE_CHARS.encode('utf-8'), np.uint8).reshape(4, 3)
+    return table[states].tobytes().decode('utf-8')
+
+def states_from_str(s: str):
+    # all arrows differ only in the last utf-8 byte
+    last = np.frombuffer(s.encode('utf-8'), np.uint8)[2::3]
+    table = np.zeros(256, np.uint8)
+    for code, char in enumerate(_STATE_CHARS):
+        table[char.encode('utf-8')[2]] = code
+    return table[last]
+
+def bits_to_str(bits) -> str:
+    return (np.asarray(bits, np.uint8) + ord('0')).tobytes().decode('ascii')
+
+def bits_from_str(s: str):
+    return np.frombuffer(s.encode('ascii'), np.uint8) - ord('0')
+
+
+# Packed binary form: number of symbols, then symbols of width bits each, most significant bit first,
+# padded with zeros to whole bytes. Bases and bits are 1 bit wide, states are 2 bits (2*basis + bit).
+# Text of BB84_User and arrays of NumpyBB84_User are accepted alike, unpack_* returns arrays,
+# or text (lists for bits) of BB84_User if text is True
+PACKED_HEADER = struct.Struct(">I")
+
+def _pack(values, width: int) -> bytes:
+    n = len(values)
+    if np is not None:
+        values = np.asarray(values, np.uint8)
+        if width == 2:
+            values = np.stack((values >> 1, values & 1), axis=1).ravel()
+        return PACKED_HEADER.pack(n) + np.packbits(values).tobytes()
+    bits = "".join(format(x, f"0{width}b") for x in values)
+    bits += "0" * (-len(bits) % 8)
+    return PACKED_HEADER.pack(n) + int(bits or "0", 2).to_bytes(len(bits) // 8, "big")
+
+def _unpack(data, width: int):
+    n, = PACKED_HEADER.unpack_from(data)
+    if len(data) - PACKED_HEADER.size != (n * width + 7) // 8:
+        raise ValueError(f"packed message of {n} symbols has {len(data) - PACKED_HEADER.size} bytes")
+    if np is not None:
+        bits = np.unpackbits(np.frombuffer(data, np.uint8, offset=PACKED_HEADER.size), count=n * width)
+        return (bits[0::2] << 1) | bits[1::2] if width == 2 else bits
+    bits = bin(int.from_bytes(data[PACKED_HEADER.size:], "big"))[2:].zfill(8 * (len(data) - PACKED_HEADER.size))
+    return [int(bits[i:i+width], 2) for i in range(0, n * width, width)]
+
+def pack_bases(bases) -> bytes:
+    if isinstance(bases, str):
+        bases = [int(c == diag_basis) for c in bases]
+    return _pack(bases, 1)
+
+def unpack_bases(data, text: bool = False):
+    bases = _unpack(data, 1)
+    return "".join(diag_basis if x else rect_basis for x in bases) if text else bases
+
+def pack_states(states) -> bytes:
+    if isinstance(states, str):
+        states = [_STATE_CHARS.index(c) for c in states]
+    return _pack(states, 2)
+
+def unpack_states(data, text: bool = False):
+    states = _unpack(data, 2)
+    return "".join(_STATE_CHARS[x] for x in states) if text else states
+
+def pack_bits(bits) -> bytes:
+    return _pack(bits, 1)
+
+def unpack_bits(data, text: bool = False):
+    bits = _unpack(data, 1)
+    return [int(x) for x in bits] if text else bits
+
+
+def _random_bits(rng, n: int):
+    # unpacking random bytes is several times faster than rng.integers(0, 2, n)
+    return np.unpackbits(np.frombuffer(rng.bytes((n + 7) // 8), np.uint8))[:n]
+
+
+class NumpyBB84_User:
+    '''
+        BB84_User on uint8 arrays: every step is a few vectorised operations instead of a loop over qubits.
+        Methods take arrays or the strings/lists of BB84_User and return arrays, see *_to_str for text
+    '''
+    def __init__(self, n: int, gen_bits: bool):
+        self.n = n
+        self.rng = np.random.default_rng()
+        if gen_bits:
+            self.bits = _random_bits(self.rng, n)
+        self.bases = _random_bits(self.rng, n)
+
+    def get_sends(self):
+        self.sends = (self.bases << 1) | self.bits
+        return self.sends
+
+    def get_observations(self, data):
+        states = states_from_str(data) if isinstance(data, str) else np.asarray(data, np.uint8)
+        assert len(states) == self.n
+        # in the same basis state is read exactly, in the other one result is random
+        same = (states >> 1) == self.bases
+        self.bits = np.where(same, states & 1, _random_bits(self.rng, self.n))
+        self.observations = (self.bases << 1) | self.bits
+        return self.bits
+
+    def get_key(self, another_bases):
+        if isinstance(another_bases, str):
+            another_bases = bases_from_str(another_bases)
+        assert len(another_bases) == self.n
+        self.key = self.bits[self.bases == np.asarray(another_bases, np.uint8)]
+        self.n = len(self.key)
+        return self.key
+
+    def get_chosen_compare(self, count: int):
+        res = np.zeros(self.n, np.uint8)
+        res[self.rng.integers(0, self.n, count)] = 1 # with repetitions, as choices()
+        return res
+
+    def get_check_bits(self, chosen_compare):
+        chosen_compare = np.asarray(chosen_compare, np.uint8)
+        assert len(chosen_compare) == self.n
+        return self.key[chosen_compare.view(bool)]
+
+    def check(self, chosen_compare, bits):
+        chosen_compare = np.asarray(chosen_compare, np.uint8).view(bool)
+        assert len(chosen_compare) == self.n
+        assert np.count_nonzero(chosen_compare) == len(bits)
+        if not np.array_equal(self.key[chosen_compare], np.asarray(bits, np.uint8)):
+            return False
+        self.key = self.key[~chosen_compare]
+        return True
+
     
+class Channel:
+    '''
+        Quantum channel of simulation for states of NumpyBB84_User. noise - part of qubits whose bit is flipped,
+        eve - part of qubits intercepted by Eve, measured in random basis and resent: she gives errors
+        in a quarter of sifted ones
+    '''
+    def __init__(self, noise: float = 0.0, eve: float = 0.0):
+        self.noise = noise
+        self.eve = eve
+        self.rng = np.random.default_rng()
+
+    def __call__(self, states):
+        states = states_from_str(states) if isinstance(states, str) else np.array(states, np.uint8)
+        n = len(states)
+        if self.eve:
+            caught = self.rng.random(n) < self.eve
+            bases = _random_bits(self.rng, n)
+            bits = np.where(bases == states >> 1, states & 1, _random_bits(self.rng, n))
+            states = np.where(caught, (bases << 1) | bits, states)
+        if self.noise:
+            states ^= (self.rng.random(n) < self.noise).view(np.uint8)
+        return states
+
+
 def gen_key(n: int):
     alice = BB84_User(n, True)
     bob = BB84_User(n, False)
@@ -108,6 +281,78 @@ def gen_key(n: int):
     print("Success!")
     print(f"Key                       : {' '.join(str(alice.key[sum(not x for x in chosen_compare[:sum(is_same_basis[:i])])]) if is_same_basis[i] and not chosen_compare[sum(is_same_basis[:i])] else ' ' for i in range(n))}")
 
+def session(cls, n: int):
+    '''
+        Whole exchange without channel, return (alice, bob)
+    '''
+    alice = cls(n, True)
+    bob = cls(n, False)
+    bob.get_observations(alice.get_sends())
+    alice.get_key(bob.bases)
+    bob.get_key(alice.bases)
+    chosen_compare = alice.get_chosen_compare(alice.n//2)
+    alice_check_bits = alice.get_check_bits(chosen_compare)
+    bob_check_bits = bob.get_check_bits(chosen_compare)
+    assert alice.check(chosen_compare, bob_check_bits) and bob.check(chosen_compare, alice_check_bits)
+    return alice, bob
+
+def benchmark(sizes=(10**4, 10**5, 10**6, 10**7), time_limit=5.0):
+    '''
+        Time of whole session for both engines, sizes expected to take over time_limit seconds are skipped
+    '''
+    import time
+    for cls in (BB84_User, NumpyBB84_User):
+        for i, n in enumerate(sizes):
+            start = time.perf_counter()
+            alice, bob = session(cls, n)
+            elapsed = time.perf_counter() - start
+            print(f"{cls.__name__:>14} {n:>9} qubits: {elapsed*1000:10.1f} ms, key {len(alice.key)} bits")
+            if i+1 < len(sizes) and elapsed * sizes[i+1] / n > time_limit:
+                break
+
+def tests():
+    alice, bob = session(NumpyBB84_User, 10000)
+    assert np.array_equal(alice.key, bob.key) and 2800 < len(alice.key) < 3300 # 5000 sifted, ~39% of them checked
+    # text form is the same as of BB84_User
+    old = BB84_User(1000, True)
+    new = NumpyBB84_User(1000, False)
+    new.bits = np.array(old.bits, np.uint8)
+    new.bases = bases_from_str(old.bases)
+    assert bases_to_str(new.bases) == old.bases
+    assert states_to_str(new.get_sends()) == old.get_sends()
+    assert np.array_equal(states_from_str(old.sends), new.sends)
+    assert bits_to_str(new.bits) == ''.join(map(str, old.bits))
+    # measurement in the same bases gives Alice's bits, text and arrays are accepted alike
+    bob = NumpyBB84_User(1000, False)
+    bob.bases = new.bases.copy()
+    assert np.array_equal(bob.get_observations(old.sends), new.bits)
+    assert np.array_equal(bob.get_key(old.bases), new.bits)
+    # packed form: text and arrays give the same bytes, 1 bit per basis and bit, 2 bits per state
+    assert pack_bases(old.bases) == pack_bases(new.bases) and len(pack_bases(old.bases)) == 4 + 125
+    assert pack_states(old.sends) == pack_states(new.sends) and len(pack_states(old.sends)) == 4 + 250
+    assert unpack_bases(pack_bases(old.bases), text=True) == old.bases
+    assert unpack_states(pack_states(new.sends), text=True) == old.sends
+    assert np.array_equal(unpack_states(pack_states(old.sends)), new.sends)
+    assert unpack_bits(pack_bits(old.bits[:13]), text=True) == old.bits[:13]
+    assert len(unpack_bits(pack_bits([]))) == 0
+    # errors of sifted key: noise itself, a quarter of intercepted qubits
+    for channel, rate in ((Channel(noise=0.05), 0.05), (Channel(eve=1.0), 0.25)):
+        alice, bob = NumpyBB84_User(40000, True), NumpyBB84_User(40000, False)
+        bob.get_observations(channel(alice.get_sends()))
+        errors = np.mean(alice.get_key(bob.bases) != bob.get_key(alice.bases))
+        assert abs(errors - rate) < 0.02, (errors, rate)
+    try:
+        unpack_bits(pack_bits([1] * 9)[:-1])
+        assert False
+    except ValueError:
+        pass
+    print("Tests passed successfully")
+
 if __name__ == '__main__':
-    n = int(input("N: "))
-    gen_key(n)
\ No newline at end of file
+    import sys
+    if '--bench' in sys.argv:
+        tests()
+        benchmark()
+    else:
+        n = int(input("N: "))
+        gen_key(n)
\ No newline at end of file
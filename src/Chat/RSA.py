@@ -1,15 +1,157 @@
-import random, math, sympy
+import random, math
+import mmap, os, struct
+
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from metrics import timed
+from AES_lib import AES128, gen_key, encrypt_buffer_len
+from keccak import shake_256
+
+PACKED_LEN_PREFIX = 4 # bytes of plaintext length before packed data
+PUBLIC_EXPONENT = 65537 # default e: public key operation takes 17 multiplications
+
+SIEVE_LIMIT = 1 << 18  # largest bound of primes sieved out of candidates before Miller-Rabin
+SIEVE_WINDOW = 1 << 12 # odd candidates in one sieve window, enough to hold a prime for 4096-bit p
+
+def _small_primes(limit: int):
+    sieve = bytearray([1]) * limit
+    sieve[:2] = b'\0\0'
+    for i in range(2, math.isqrt(limit) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = bytes(len(range(i*i, limit, i)))
+    return [i for i in range(limit) if sieve[i]]
+
+_SMALL_PRIMES = _small_primes(1 << 12)
+_sieve_primes = {} # bound -> odd primes below it, built on first use
+
+def _odd_primes_below(limit: int):
+    if limit not in _sieve_primes:
+        _sieve_primes[limit] = _small_primes(limit)[1:]
+    return _sieve_primes[limit]
+
+def _sieve_bound(bits: int):
+    '''
+        Sieving by more primes is worth it while it is cheaper than Miller-Rabin tests it saves,
+        which grow as bits^3. Bound is chosen by measurement: 4096 for 256-bit, 65536 for 1024-bit primes
+    '''
+    return min(SIEVE_LIMIT, max(1 << 12, bits * bits // 16))
+
+def _miller_rabin_rounds(bits: int):
+    '''
+        Rounds for error probability below 2^-80 for random candidates (as OpenSSL BN_prime_checks_for_size)
+    '''
+    for min_bits, rounds in ((3747, 3), (1345, 4), (476, 5), (400, 6), (347, 7), (308, 8), (55, 27)):
+        if bits >= min_bits:
+            return rounds
+    return 34
+
+def is_probable_prime(n: int, rounds: int = None):
+    '''
+        Trial division by small primes, then Miller-Rabin with random bases
+    '''
+    if n < 2:
+        return False
+    for p in _SMALL_PRIMES[:64]:
+        if n % p == 0:
+            return n == p
+    if rounds is None:
+        rounds = _miller_rabin_rounds(n.bit_length())
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def _prime_in_window(bits: int):
+    '''
+        Sieve SIEVE_WINDOW odd numbers from random start with two top bits set,
+        test the rest by Miller-Rabin. Return first prime of exactly bits bits or None
+    '''
+    start = random.getrandbits(bits) | (3 << (bits - 2)) | 1
+    # sieve[j] is for start + 2*j
+    sieve = bytearray([1]) * SIEVE_WINDOW
+    for p in _odd_primes_below(_sieve_bound(bits)):
+        # start + 2*j = 0 (mod p)  =>  j = -start / 2 (mod p)
+        j = (p - start % p) * ((p + 1) // 2) % p
+        sieve[j::p] = bytes(len(range(j, SIEVE_WINDOW, p)))
+    rounds = _miller_rabin_rounds(bits)
+    for j in range(SIEVE_WINDOW):
+        if sieve[j]:
+            candidate = start + 2 * j
+            if candidate.bit_length() != bits:
+                return None
+            if is_probable_prime(candidate, rounds):
+                return candidate
+    return None
+
+def random_prime(bits: int, executor=None, workers: int = None):
+    '''
+        Random prime of exactly bits bits, with two top bits set, so product of two such primes
+        has exactly 2*bits bits.
+        executor - optional process pool, windows are searched on all its workers at once
+        workers - number of workers of executor, os.cpu_count() by default
+    '''
+    if bits < 16: # sieve primes may be candidates themselves
+        while True:
+            candidate = random.getrandbits(bits) | (3 << (bits - 2)) | 1
+            if is_probable_prime(candidate):
+                return candidate
+    if executor is None:
+        while True:
+            prime = _prime_in_window(bits)
+            if prime is not None:
+                return prime
+    pending = {executor.submit(_prime_in_window, bits) for _ in range(workers or os.cpu_count() or 1)}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            prime = future.result()
+            if prime is not None:
+                for rest in pending:
+                    rest.cancel()
+                return prime
+            pending.add(executor.submit(_prime_in_window, bits))
 
 class RSA:
-    def __init__(self, n, e=None, d=None):
+    def __init__(self, n, e=None, d=None, p=None, q=None):
         '''
             n = RSA modulus 
             d = private key
             e = public key
+            p, q = primes of n, if known private key operations use CRT
         '''
         self.n = n
         self.d = d
         self.e = e
+        self.p = self.q = None
+        if d is not None and p is not None and q is not None:
+            if p*q != n:
+                raise ValueError("p*q != n")
+            self.p, self.q = p, q
+            self.dP = d % (p-1)
+            self.dQ = d % (q-1)
+            self.qInv = pow(q, -1, p)
+
+    def _pow_private(self, x: int):
+        '''
+            x^d mod n, with primes - by CRT and Garner's recombination
+        '''
+        if self.p is None:
+            return pow(x, self.d, self.n)
+        m1 = pow(x, self.dP, self.p)
+        m2 = pow(x, self.dQ, self.q)
+        h = self.qInv * (m1 - m2) % self.p
+        return m2 + h * self.q
 
     @staticmethod
     def extgcd(a: int, b: int):
@@ -26,104 +168,476 @@ class RSA:
         return (a, x0, y0)
 
     @staticmethod
-    def generate_key(key_len: int):
+    @timed("rsa.generate_key")
+    def generate_key(key_len: int, with_primes: bool = False, executor=None, e: int = PUBLIC_EXPONENT,
+                     workers: int = None):
         '''
-            Generate keys for RSA. Each prime in range (sqrt(2^key_len), 2^key_len)
+            Generate keys for RSA, n has exactly key_len bits.
             Return tuple (n, e, d), where (n, e) is public key, (n, d) - private
+            If with_primes: return (n, e, d, p, q)
+            executor - optional process pool for prime search, workers - its number of workers
+            e - public exponent, prime; None - random e of modulus size
         '''
-        lower_bound = 2**(key_len//4)
-        upper_bound = 2**(key_len//2)
-        gen_prime = lambda: sympy.randprime(lower_bound, upper_bound)
+        def gen_prime(bits):
+            while True:
+                prime = random_prime(bits, executor, workers)
+                if e is None or (prime - 1) % e != 0: # e must be invertible mod p-1
+                    return prime
 
-        p = gen_prime()
+        p = gen_prime(key_len - key_len//2)
         while True:
-            q = gen_prime()
+            q = gen_prime(key_len//2)
             if p != q:
                 break
         
         n = p*q
         phi = math.lcm(p-1, q-1)
 
-        while True:
-            e = random.randint(3, phi-1)
-            cur_gcd, d, _ = RSA.extgcd(e, phi)
-            if cur_gcd == 1:
-                break
+        if e is None:
+            while True:
+                e = random.randint(3, phi-1)
+                cur_gcd, d, _ = RSA.extgcd(e, phi)
+                if cur_gcd == 1:
+                    break
+        else:
+            _, d, _ = RSA.extgcd(e, phi)
         d = (d%phi + phi)%phi
+        if with_primes:
+            return (n, e, d, p, q)
         return (n, e, d)
 
-    def encrypt(self, plaintext: bytes):
+    def encrypt(self, plaintext: bytes, packed: bool = False):
+        '''
+            packed = False: each byte is encrypted separately (old format)
+            packed = True: plaintext with 4-byte length prefix is split in blocks of block_payload_len() bytes,
+            the last block is filled with random bytes, so the same plaintext gives different ciphertexts
+        '''
         if self.e == None:
             raise RuntimeError("Private key is unspecified")
+        if packed:
+            k = self.block_payload_len()
+            data = len(plaintext).to_bytes(PACKED_LEN_PREFIX, "big") + bytes(plaintext)
+            data += os.urandom(-len(data) % k)
+            plaintext = (int.from_bytes(data[i:i+k], "big") for i in range(0, len(data), k))
         chifered = (pow(x, self.e, self.n) for x in plaintext) # encrypt
         bytes_chifered = (x.to_bytes(self.len_n(), "big") for x in chifered) # encode to bytes array
         return bytes().join(bytes_chifered) # concatenate
 
-    def decrypt(self, ciphertext: bytes):
+    def decrypt(self, ciphertext: bytes, packed: bool = False):
+        '''
+            packed must be the same as for encryption
+        '''
         if self.d == None:
             raise RuntimeError("Public key is unspecified")
         # split bytes in segments, each of length of RSA modulus
         splitted = (ciphertext[i:i+self.len_n()] for i in range(0, len(ciphertext), self.len_n()))
         ints = (int.from_bytes(x, "big") for x in splitted) # convert to ints
-        return bytes(pow(x, self.d, self.n) for x in ints) # decrypt
-    
+        if not packed:
+            return bytes(self._pow_private(x) for x in ints) # decrypt
+        k = self.block_payload_len()
+        data = b''.join(self._pow_private(x).to_bytes(k, "big") for x in ints)
+        length = int.from_bytes(data[:PACKED_LEN_PREFIX], "big")
+        if length > len(data) - PACKED_LEN_PREFIX:
+            raise ValueError("wrong packed ciphertext")
+        return data[PACKED_LEN_PREFIX:PACKED_LEN_PREFIX+length]
+
+    def block_payload_len(self):
+        # plaintext bytes per block in packed mode, one byte less than n to keep block < n
+        return self.len_n() - 1
+
     def len_n(self):
         # ceil division
         return (self.n.bit_length() + 7) // 8
 
-def save(n, e, d):
+# Hybrid file format: RSA encrypts only random AES key, data goes through AES128 by chunks.
+# Header: magic, version, wrapped key length, original length, chunk size; then wrapped key and chunks.
+# Each chunk of plaintext (CHUNK_LEN bytes, the last one shorter) is encrypted separately
+# with its whole PKCS#7 padding, so it is encrypt_buffer_len(len(chunk)) bytes long.
+# Version 2: key is wrapped in packed mode and every chunk has its own AES key derived from file key,
+# version 1 (still readable) wrapped key byte by byte and used file key for all chunks
+FILE_MAGIC = b'RSAE'
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct('>4sBIQI')
+CHUNK_LEN = 1 << 20
+
+def _chunks(length, chunk_len):
+    '''
+        Split file of length bytes to chunks, last chunk may be empty
+        Yield (plaintext position, chunk length, chifertext position relative to data start)
+    '''
+    pos = out_pos = 0
+    while True:
+        size = min(chunk_len, length - pos)
+        yield pos, size, out_pos
+        if size < chunk_len:
+            return
+        pos += size
+        out_pos += encrypt_buffer_len(size)
+
+def _chunk_aes(key, index, version=FILE_VERSION):
+    '''
+        AES for chunk number index: CBC starts from zero IV in every chunk,
+        so equal chunks must not be encrypted with the same key
+    '''
+    if version == 1:
+        return AES128(gen_key(key))
+    return AES128(gen_key(shake_256(b"RSAE chunk" + bytes(key) + index.to_bytes(8, "big"), len(key))))
+
+def _unwrap_key(wrapped_key, rsa, version):
+    return rsa.decrypt(wrapped_key, packed=version > 1)
+
+def _pack_header(wrapped_key, length, chunk_len):
+    return FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, len(wrapped_key), length, chunk_len) + wrapped_key
+
+def _unpack_header(header):
+    '''
+        Return (version, wrapped key length, original length, chunk length) from FILE_HEADER.size bytes
+    '''
+    if len(header) < FILE_HEADER.size:
+        raise ValueError("unsupported file format")
+    magic, version, key_len, length, chunk_len = FILE_HEADER.unpack(header)
+    if magic != FILE_MAGIC or version not in (1, FILE_VERSION):
+        raise ValueError("unsupported file format")
+    return version, key_len, length, chunk_len
+
+def seal(plaintext: bytes, rsa, chunk_len: int = CHUNK_LEN):
+    '''
+        In-memory version of encrypt_file, result has the same format
+    '''
+    if chunk_len <= 0 or chunk_len % 16:
+        raise ValueError("chunk length must be a multiple of AES block")
+    key = bytes(gen_key())
+    header = _pack_header(rsa.encrypt(key, packed=True), len(plaintext), chunk_len)
+
+    chunks = list(_chunks(len(plaintext), chunk_len))
+    _, last_size, last_pos = chunks[-1]
+    res = bytearray(len(header) + last_pos + encrypt_buffer_len(last_size))
+    res[:len(header)] = header
+    with memoryview(plaintext) as src, memoryview(res) as dst:
+        for index, (pos, size, out_pos) in enumerate(chunks):
+            out_pos += len(header)
+            _chunk_aes(key, index).encrypt_into(src[pos:pos+size], dst[out_pos:out_pos+encrypt_buffer_len(size)])
+    return bytes(res)
+
+def unseal(envelope: bytes, rsa):
+    '''
+        In-memory version of decrypt_file
+    '''
+    version, key_len, length, chunk_len = _unpack_header(envelope[:FILE_HEADER.size])
+    data_start = FILE_HEADER.size + key_len
+    key = _unwrap_key(envelope[FILE_HEADER.size:data_start], rsa, version)
+
+    res = bytearray(length)
+    scratch = bytearray(encrypt_buffer_len(chunk_len))
+    with memoryview(envelope) as src, memoryview(res) as dst, memoryview(scratch) as scratch_view:
+        for index, (pos, size, in_pos) in enumerate(_chunks(length, chunk_len)):
+            in_pos += data_start
+            in_end = in_pos + encrypt_buffer_len(size)
+            if in_end > len(src):
+                raise ValueError("file is truncated")
+            _chunk_aes(key, index, version).decrypt_into(src[in_pos:in_end], scratch_view)
+            dst[pos:pos+size] = scratch_view[:size]
+    return bytes(res)
+
+def _map(path, length, write):
+    '''
+        Memory-map whole file, for writing create it of given length
+        Return None for empty file, as it can't be mapped
+    '''
+    if write:
+        with open(path, "wb") as f:
+            f.truncate(length)
+    if length == 0:
+        return None
+    with open(path, "r+b" if write else "rb") as f:
+        # private copy-on-write mapping for reading, so native AES gets pointer into it without a copy
+        return mmap.mmap(f.fileno(), length, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_COPY)
+
+def _release(m, start, end, write):
+    '''
+        Drop already processed pages [start, end) of mapping from memory, so resident size
+        doesn't grow with file size. Return new start
+    '''
+    end -= end % mmap.PAGESIZE
+    if m is None or end <= start or not hasattr(mmap, 'MADV_DONTNEED'):
+        return start
+    if write:
+        m.flush(start, end - start)
+    m.madvise(mmap.MADV_DONTNEED, start, end - start)
+    return end
+
+def encrypt_file(from_path, to_path, rsa: RSA, chunk_len: int = CHUNK_LEN):
+    '''
+        Encrypt file with new AES key, wrapped by RSA public key.
+        Both files are memory-mapped and processed by chunks, memory usage doesn't depend on file size
+    '''
+    if chunk_len <= 0 or chunk_len % 16:
+        raise ValueError("chunk length must be a multiple of AES block")
+    key = bytes(gen_key())
+    wrapped_key = rsa.encrypt(key, packed=True)
+    length = os.path.getsize(from_path)
+
+    chunks = list(_chunks(length, chunk_len))
+    _, last_size, last_pos = chunks[-1]
+    data_start = FILE_HEADER.size + len(wrapped_key)
+    out_len = data_start + last_pos + encrypt_buffer_len(last_size)
+
+    src = _map(from_path, length, False)
+    dst = _map(to_path, out_len, True)
+    try:
+        with memoryview(src if src is not None else b'') as src_view, memoryview(dst) as dst_view:
+            dst_view[:data_start] = _pack_header(wrapped_key, length, chunk_len)
+            src_done = dst_done = 0
+            for index, (pos, size, out_pos) in enumerate(chunks):
+                out_end = data_start + out_pos + encrypt_buffer_len(size)
+                _chunk_aes(key, index).encrypt_into(src_view[pos:pos+size], dst_view[data_start+out_pos:out_end])
+                src_done = _release(src, src_done, pos + size, False)
+                dst_done = _release(dst, dst_done, out_end, True)
+    finally:
+        if src is not None:
+            src.close()
+        dst.close()
+
+def decrypt_file(from_path, to_path, rsa: RSA):
+    '''
+        Decrypt file made by encrypt_file with RSA private key.
+        Files without the header are taken as old format, RSA-encrypted byte by byte
+    '''
+    with open(from_path, "rb") as f:
+        header = f.read(FILE_HEADER.size)
+        if not header.startswith(FILE_MAGIC):
+            ciphertext = header + f.read()
+            with open(to_path, "wb") as out:
+                out.write(rsa.decrypt(ciphertext))
+            return
+        version, key_len, length, chunk_len = _unpack_header(header)
+        key = _unwrap_key(f.read(key_len), rsa, version)
+    data_start = FILE_HEADER.size + key_len
+
+    src = _map(from_path, os.path.getsize(from_path), False)
+    dst = _map(to_path, length, True)
+    scratch = bytearray(encrypt_buffer_len(chunk_len))
+    try:
+        with memoryview(src) as src_view, memoryview(dst if dst is not None else bytearray()) as dst_view, \
+             memoryview(scratch) as scratch_view:
+            src_done = dst_done = 0
+            for index, (pos, size, in_pos) in enumerate(_chunks(length, chunk_len)):
+                in_pos += data_start
+                in_end = in_pos + encrypt_buffer_len(size)
+                if in_end > len(src_view):
+                    raise ValueError("file is truncated")
+                _chunk_aes(key, index, version).decrypt_into(src_view[in_pos:in_end], scratch_view)
+                dst_view[pos:pos+size] = scratch_view[:size]
+                src_done = _release(src, src_done, in_end, False)
+                dst_done = _release(dst, dst_done, pos + size, True)
+    finally:
+        src.close()
+        if dst is not None:
+            dst.close()
+
+def save(n, e, d, p=None, q=None):
     with open("public.key", "w") as f:
         f.write(str(n) + ", " + str(e))
 
     with open("private.key", "w") as f:
-        f.write(str(n) + ", " + str(d))
+        if p is None:
+            f.write(str(n) + ", " + str(d))
+        else:
+            key = RSA(n, d=d, p=p, q=q)
+            f.write(", ".join(map(str, (n, d, p, q, key.dP, key.dQ, key.qInv))))
+
+def load_private(path="private.key"):
+    '''
+        Read private key: "n, d" or "n, d, p, q, dP, dQ, qInv"
+    '''
+    with open(path, "r") as f:
+        fields = list(map(int, f.read().split(", ")))
+    if len(fields) == 2:
+        return RSA(fields[0], d=fields[1])
+    if len(fields) != 7:
+        raise ValueError(f"private key has {len(fields)} fields")
+    n, d, p, q, dP, dQ, qInv = fields
+    key = RSA(n, d=d, p=p, q=q)
+    # stored CRT values are used only if they agree with p, q and d, a damaged one would give wrong results
+    if (dP, dQ, qInv) != (key.dP, key.dQ, key.qInv):
+        raise ValueError("dP, dQ, qInv of private key don't match p, q and d")
+    return key
 
 def main():
     choise = input("What do you want? (enc/dec/gen) ")
     if choise == "gen":
         key_len = int(input("Enter lenght of keys: "))
         print("...Generating...")
-        n, e, d = RSA.generate_key(key_len) 
-        save(n, e, d)
+        n, e, d, p, q = RSA.generate_key(key_len, with_primes=True)
+        save(n, e, d, p, q)
         print("Done!")
 
     elif choise == "enc":
         from_path = input("Enter the path to the file to encrypt: ")
         to_path = input("Enter the path to the file to save: ")
 
-        with open(from_path, "rb") as f:
-            plaintext = f.read()
-
         print("...Encrypting...")
 
         with open("public.key", "r") as f:
             n, e = map(int, f.read().split(", "))
 
-        ciphertext = RSA(n, e=e).encrypt(plaintext)
-
-        with open(to_path, "wb") as f:
-            f.write(ciphertext)
+        encrypt_file(from_path, to_path, RSA(n, e=e))
 
         print("Done!")
 
     elif choise == "dec":
         from_path = input("Enter the path to encrypted file: ")
         to_path = input("Enter the path to the file to save: ")
-        with open(from_path, "rb") as f:
-            ciphertext = f.read()
-
         print("...Decrypting...")
         
-        with open("private.key", "r") as f:
-            n, d = map(int, f.read().split(", "))
-
-        plaintext = RSA(n, d=d).decrypt(ciphertext)
-        with open(to_path, "wb") as f:
-            f.write(plaintext)
+        decrypt_file(from_path, to_path, load_private())
         print("Done!")
 
     else:
         print("!!!!Incorrect Input!!!!")
 
+def benchmark(size: int = 8 << 20, key_len: int = 512):
+    '''
+        Compare per-byte RSA with hybrid envelope, per-byte throughput is measured on 1 KiB
+        Both are extrapolated to 100 MiB
+    '''
+    import time
+    n, e, d = RSA.generate_key(key_len)
+    public, private = RSA(n, e=e), RSA(n, d=d)
+    target = 100 << 20
+
+    sample = os.urandom(1 << 10)
+    start = time.perf_counter()
+    ciphertext = public.encrypt(sample)
+    enc_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert private.decrypt(ciphertext) == sample
+    dec_time = time.perf_counter() - start
+    scale = target / len(sample)
+    print(f"per-byte RSA: encrypt {enc_time*scale:10.1f} s, decrypt {dec_time*scale:10.1f} s per 100 MiB")
+
+    data = os.urandom(size)
+    start = time.perf_counter()
+    envelope = seal(data, public)
+    enc_time = time.perf_counter() - start
+    start = time.perf_counter()
+    assert unseal(envelope, private) == data
+    dec_time = time.perf_counter() - start
+    scale = target / size
+    print(f"hybrid ({AES128.__name__}): encrypt {enc_time*scale:10.1f} s, decrypt {dec_time*scale:10.1f} s per 100 MiB, "
+          f"size overhead {len(envelope) - size} B")
+
+def benchmark_crt(key_lens=(512, 1024, 2048, 4096), count: int = 20):
+    '''
+        Compare private key operation x^d mod n with and without CRT
+    '''
+    import time
+    for key_len in key_lens:
+        n, e, d, p, q = RSA.generate_key(key_len, with_primes=True)
+        plain, crt = RSA(n, d=d), RSA(n, d=d, p=p, q=q)
+        xs = [random.randrange(2, n) for _ in range(count)]
+        start = time.perf_counter()
+        res = [plain._pow_private(x) for x in xs]
+        plain_time = (time.perf_counter() - start) / count
+        start = time.perf_counter()
+        assert [crt._pow_private(x) for x in xs] == res
+        crt_time = (time.perf_counter() - start) / count
+        print(f"{n.bit_length():>5}-bit n: pow {plain_time*1000:9.3f} ms, CRT {crt_time*1000:9.3f} ms, "
+              f"x{plain_time/crt_time:.1f}")
+
+def benchmark_keygen(key_lens=(2048, 3072, 4096), count: int = 3, processes: int = os.cpu_count()):
+    '''
+        Key generation time: sieve + Miller-Rabin, the same on process pool, and sympy.randprime
+        for primes of the same size
+    '''
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        start = time.perf_counter()
+        import sympy
+        print(f"sympy import {(time.perf_counter() - start)*1000:.0f} ms")
+    except ImportError:
+        sympy = None
+    executor = ProcessPoolExecutor(processes)
+    for key_len in key_lens:
+        line = f"{key_len:>5}-bit key:"
+        for name, generate in (("sieve+MR", lambda: RSA.generate_key(key_len)),
+                               (f"{processes} processes", lambda: RSA.generate_key(key_len, executor=executor, workers=processes))):
+            start = time.perf_counter()
+            for _ in range(count):
+                n, e, d = generate()
+                assert n.bit_length() == key_len
+            line += f"  {name} {(time.perf_counter() - start)/count*1000:9.1f} ms"
+        if sympy is not None:
+            bits = key_len // 2
+            start = time.perf_counter()
+            for _ in range(count):
+                sympy.randprime(3 << (bits - 2), 1 << bits)
+                sympy.randprime(3 << (bits - 2), 1 << bits)
+            line += f"  sympy {(time.perf_counter() - start)/count*1000:9.1f} ms"
+        print(line)
+    executor.shutdown()
+
+def tests():
+    assert [n for n in range(200) if is_probable_prime(n)] == _SMALL_PRIMES[:46]
+    # Carmichael numbers and strong pseudoprimes to several bases
+    for n in (561, 41041, 3215031751, 3825123056546413051, 318665857834031151167461):
+        assert not is_probable_prime(n), n
+    assert is_probable_prime(2**521 - 1) and not is_probable_prime(2**523 - 1)
+    for key_len, exponent in ((64, PUBLIC_EXPONENT), (65, None), (512, PUBLIC_EXPONENT), (512, None), (1024, 3)):
+        n, e, d, p, q = RSA.generate_key(key_len, with_primes=True, e=exponent)
+        assert n.bit_length() == key_len and p*q == n and e == (exponent or e)
+        rsa = RSA(n, e=e, d=d, p=p, q=q)
+        assert rsa.decrypt(rsa.encrypt(b"Hello", packed=True), packed=True) == b"Hello"
+    # hybrid envelope: randomised key wrapping, equal chunks differ, version 1 is still readable
+    public, private = RSA(n, e=e), RSA(n, d=d, p=p, q=q)
+    assert public.encrypt(b"Hello", packed=True) != public.encrypt(b"Hello", packed=True)
+    data = bytes(64) + os.urandom(40)
+    envelope = seal(data, public, chunk_len=32)
+    assert unseal(envelope, private) == data
+    assert seal(data, public, chunk_len=32) != envelope
+    chunk_start = FILE_HEADER.size + public.len_n()
+    assert envelope[chunk_start:chunk_start+48] != envelope[chunk_start+48:chunk_start+96]
+    key = bytes(gen_key())
+    old = bytearray(_pack_header(public.encrypt(key), len(data), 32))
+    old[4] = 1
+    for pos, size, _ in _chunks(len(data), 32):
+        chunk = bytearray(encrypt_buffer_len(size))
+        AES128(gen_key(key)).encrypt_into(data[pos:pos+size], chunk)
+        old += chunk
+    assert unseal(bytes(old), private) == data
+    import tempfile
+    directory = tempfile.mkdtemp()
+    paths = [os.path.join(directory, name) for name in ("plain", "sealed", "opened")]
+    with open(paths[0], "wb") as f:
+        f.write(data)
+    encrypt_file(paths[0], paths[1], public, chunk_len=32)
+    decrypt_file(paths[1], paths[2], private)
+    with open(paths[2], "rb") as f:
+        assert f.read() == data
+    # private key file: CRT values are checked against p and q
+    path = os.path.join(directory, "private.key")
+    with open(path, "w") as f:
+        f.write(", ".join(map(str, (n, d, p, q, rsa.dP, rsa.dQ, rsa.qInv))))
+    assert load_private(path).qInv == rsa.qInv
+    with open(path, "w") as f:
+        f.write(", ".join(map(str, (n, d, p, q, rsa.dP + 1, rsa.dQ, rsa.qInv))))
+    try:
+        load_private(path)
+        assert False
+    except ValueError:
+        pass
+    print("Tests passed successfully")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import sys
+    if '--bench-keygen' in sys.argv:
+        benchmark_keygen()
+    elif '--test' in sys.argv:
+        tests()
+    elif '--bench-crt' in sys.argv:
+        benchmark_crt()
+    elif '--bench' in sys.argv:
+        benchmark()
+    else:
+        main()
\ No newline at end of file
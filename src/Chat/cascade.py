@@ -0,0 +1,302 @@
+'''
+    Cascade error reconciliation of sifted BB84 key, on NumPy arrays of bits.
+    Alice's key is the reference, Bob corrects his copy. Both sides run the same Cascade object:
+    block parities are exchanged, then for every search one side discloses parity of the first half
+    and the other answers whether it differs, so both know the state of every search.
+    Parities of all passes are exchanged at once: Alice's key does not change, and every correction
+    changes parity of its block in every pass, so differing blocks of later passes are known without
+    new messages. Passes are still searched one after another, a pass starts when searches of the
+    previous ones are finished. Binary searches of all differing blocks run together, one round-trip
+    per halving, and block parities are computed on packed bits.
+    After a correction blocks of the earlier passes which contain the corrected bit change their
+    parity, the differing ones are searched again (the cascade).
+'''
+
+import math
+
+import numpy as np
+
+from keccak import sha3_256, shake_256
+
+PASSES = 4
+MIN_BLOCK = 8        # block sizes are powers of two, multiples of 8 for packbits
+MAX_BLOCK = 1 << 14
+VERIFY_LEN = 8       # bytes of hash comparing corrected keys
+AMPLIFY_MARGIN = 64  # bits removed by privacy amplification above estimated knowledge of Eve
+_PARITY = np.array([bin(x).count("1") & 1 for x in range(256)], np.uint8)
+
+
+def block_size(qber: float):
+    '''
+        Size of blocks of the first pass, about 0.73/QBER: one error in a block on average
+    '''
+    size = 0.73 / max(qber, 0.73 / MAX_BLOCK)
+    return int(min(MAX_BLOCK, max(MIN_BLOCK, 1 << round(math.log2(size)))))
+
+def entropy(p: float):
+    '''
+        Binary entropy, bits of information of Eve per bit of key with error rate p
+    '''
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
+
+def block_parities(bits, size: int):
+    '''
+        Parities of consecutive blocks of size bits, the last one is padded with zeros
+    '''
+    pad = -len(bits) % size
+    if pad:
+        bits = np.concatenate((bits, np.zeros(pad, np.uint8)))
+    packed = np.packbits(bits).reshape(-1, size // 8)
+    return _PARITY[np.bitwise_xor.reduce(packed, axis=1)]
+
+
+class Cascade:
+    '''
+        State of reconciliation of one side.
+        bits - sifted key, copied; corrected in place if correct is True (Bob)
+        size - block size of the first pass, doubled in every next one
+        seed - the same on both sides, permutations of passes after the first one are made from it
+    '''
+    def __init__(self, bits, size: int, seed: int, correct: bool):
+        self.bits = np.array(bits, np.uint8)
+        self.n = len(self.bits)
+        self.correct = correct
+        self.sizes = [min(size << i, MAX_BLOCK) for i in range(PASSES)]
+        rng = np.random.default_rng(seed)
+        self.perms = [None] + [rng.permutation(self.n) for _ in range(PASSES - 1)]
+        self.positions = [None] * PASSES # position of key bit in order of pass, made when needed
+        self.mismatch = [] # for every pass: blocks with odd number of differing bits, after parities are exchanged
+        self.prefix = [None] * PASSES # prefix parities of own bits in order of pass, None if outdated
+        self.started = 0   # passes whose blocks are searched
+        self.search = None # pass, block, lo, hi of running binary searches, ranges in order of pass
+        self.leaked = 0    # parities disclosed by Alice
+        self.corrected = 0
+
+    def _ordered(self, j: int):
+        return self.bits if self.perms[j] is None else self.bits[self.perms[j]]
+
+    def _position(self, j: int, p):
+        if self.perms[j] is None:
+            return p
+        if self.positions[j] is None:
+            self.positions[j] = np.empty(self.n, np.int64)
+            self.positions[j][self.perms[j]] = np.arange(self.n)
+        return self.positions[j][p]
+
+    def _prefix(self, j: int):
+        if self.prefix[j] is None:
+            self.prefix[j] = np.concatenate(([0], np.bitwise_xor.accumulate(self._ordered(j)))).astype(np.uint8)
+        return self.prefix[j]
+
+    def done(self):
+        return self.search is None and self.started == PASSES
+
+    def parities(self):
+        '''
+            Block parities of all passes, concatenated
+        '''
+        res = np.concatenate([block_parities(self._ordered(j), size) for j, size in enumerate(self.sizes)])
+        self.leaked += len(res)
+        return res
+
+    def set_mismatch(self, mismatch):
+        '''
+            Start searches: mismatch - blocks whose parities differ, Alice's parities xor Bob's ones
+        '''
+        counts = [-(-self.n // size) for size in self.sizes]
+        mismatch = np.array(mismatch, np.uint8)
+        if len(mismatch) != sum(counts):
+            raise ValueError(f"{len(mismatch)} block parities instead of {sum(counts)}")
+        self.mismatch = np.split(mismatch, np.cumsum(counts)[:-1])
+        self._start_searches()
+
+    def _differing(self, j: int, keep):
+        '''
+            Searches of differing blocks of pass j which are not in keep
+        '''
+        blocks = np.flatnonzero(self.mismatch[j])
+        searched = keep[1][keep[0] == j] if keep is not None else ()
+        if len(searched):
+            blocks = blocks[np.isin(blocks, searched, invert=True)]
+        if not len(blocks):
+            return []
+        lo = blocks * self.sizes[j]
+        return [(np.full(len(blocks), j), blocks, lo, np.minimum(lo + self.sizes[j], self.n))]
+
+    def _start_searches(self, keep=None):
+        '''
+            Search all differing blocks of started passes, the next passes are started while
+            there is nothing to search. keep - searches to continue, (pass, block, lo, hi) arrays
+        '''
+        parts = [keep] if keep is not None and len(keep[0]) else []
+        for j in range(self.started):
+            parts += self._differing(j, keep)
+        while not parts and self.started < PASSES:
+            self.started += 1
+            parts += self._differing(self.started - 1, keep)
+        self.search = tuple(np.concatenate(x) for x in zip(*parts)) if parts else None
+
+    def half_parities(self):
+        '''
+            Parities of the first halves of searched ranges
+        '''
+        passes, _, lo, hi = self.search
+        mid = (lo + hi) // 2
+        res = np.empty(len(lo), np.uint8)
+        for j in range(self.started):
+            mask = passes == j
+            if mask.any():
+                prefix = self._prefix(j)
+                res[mask] = prefix[mid[mask]] ^ prefix[lo[mask]]
+        self.leaked += len(lo)
+        return res
+
+    def narrow(self, choices):
+        '''
+            choices - 1 if the first half of range has the same parity on both sides,
+            so the error is in the second one. Ranges of one bit are corrected
+        '''
+        passes, blocks, lo, hi = self.search
+        mid = (lo + hi) // 2
+        right = np.asarray(choices, bool)
+        lo = np.where(right, mid, lo)
+        hi = np.where(right, hi, mid)
+        found = hi - lo == 1
+        if not found.any():
+            self.search = (passes, blocks, lo, hi)
+            return
+        p = np.empty(np.count_nonzero(found), np.int64)
+        for j in range(self.started):
+            mask = passes[found] == j
+            if mask.any():
+                q = lo[found][mask]
+                p[mask] = q if self.perms[j] is None else self.perms[j][q]
+        p = np.unique(p) # searches of different passes may find the same bit
+        if self.correct:
+            self.bits[p] ^= 1
+            self.prefix = [None] * PASSES
+        self.corrected += len(p)
+        # every correction changes parity of its block in every pass, searches of
+        # such blocks are no longer valid and start again if the block still differs
+        keep = ~found
+        for i, mismatch in enumerate(self.mismatch):
+            changed = self._position(i, p) // self.sizes[i]
+            np.bitwise_xor.at(mismatch, changed, 1)
+            keep &= ~((passes == i) & np.isin(blocks, changed))
+        self._start_searches((passes[keep], blocks[keep], lo[keep], hi[keep]))
+
+    def qber(self):
+        return self.corrected / self.n if self.n else 0.0
+
+    def secure_len(self, margin: int = 0):
+        '''
+            Bits of key left after privacy amplification: Eve may know n*h(QBER) bits from intercepted qubits,
+            and everything disclosed during reconciliation
+        '''
+        return max(0, int(self.n * (1 - entropy(self.qber()))) - self.leaked - margin)
+
+    def digest(self):
+        '''
+            Hash of corrected key, Bob sends it and Alice compares it with her own one
+        '''
+        self.leaked += VERIFY_LEN * 8
+        return sha3_256(b"cascade verify" + np.packbits(self.bits).tobytes())[:VERIFY_LEN]
+
+    def amplify(self):
+        '''
+            Privacy amplification: key of secure_len bits, hashed from the whole corrected key
+        '''
+        nbytes = self.secure_len(AMPLIFY_MARGIN) // 8
+        if nbytes == 0:
+            return np.zeros(0, np.uint8)
+        key = shake_256(b"cascade key" + np.packbits(self.bits).tobytes(), nbytes)
+        return np.unpackbits(np.frombuffer(bytes(key), np.uint8))
+
+
+def reconcile(alice_bits, bob_bits, size: int, seed: int = 0):
+    '''
+        Both sides in one process, messages are passed directly. Return (alice, bob, round_trips)
+    '''
+    alice = Cascade(alice_bits, size, seed, correct=False)
+    bob = Cascade(bob_bits, size, seed, correct=True)
+    mismatch = alice.parities() ^ bob.parities()
+    alice.set_mismatch(mismatch)
+    bob.set_mismatch(mismatch)
+    round_trips = 1
+    while not alice.done():
+        round_trips += 1
+        choices = (alice.half_parities() == bob.half_parities()).view(np.uint8)
+        alice.narrow(choices)
+        bob.narrow(choices)
+    return alice, bob, round_trips
+
+
+def _noisy(rng, n: int, qber: float):
+    alice = np.unpackbits(np.frombuffer(rng.bytes((n + 7) // 8), np.uint8))[:n]
+    return alice, alice ^ (rng.random(n) < qber).view(np.uint8)
+
+def benchmark(sizes=(10**4, 10**5, 10**6), qbers=(0.01, 0.03, 0.05, 0.08)):
+    '''
+        Reconciliation of keys with random errors: residual errors, leaked bits against
+        Shannon limit n*h(QBER), round-trips and throughput in corrected key bits per second
+    '''
+    import time
+    rng = np.random.default_rng(1)
+    for n in sizes:
+        for qber in qbers:
+            alice_bits, bob_bits = _noisy(rng, n, qber)
+            start = time.perf_counter()
+            alice, bob, round_trips = reconcile(alice_bits, bob_bits, block_size(qber))
+            elapsed = time.perf_counter() - start
+            residual = int(np.count_nonzero(alice.bits != bob.bits))
+            print(f"{n:>8} bits, QBER {bob.qber():.4f}: residual errors {residual:>3}, "
+                  f"leaked {bob.leaked:>7} bits ({bob.leaked / (n * entropy(bob.qber())):.2f} of limit), "
+                  f"{round_trips:>3} round-trips, {n / elapsed / 1e6:6.2f} Mbit/s")
+
+
+def tests():
+    rng = np.random.default_rng(7)
+    assert np.array_equal(block_parities(np.array([1, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1], np.uint8), 8), [1, 1])
+    assert block_size(0.01) == 64 and block_size(0) == MAX_BLOCK and block_size(0.5) == MIN_BLOCK
+    for n, qber in ((1000, 0.0), (1000, 0.02), (20000, 0.05), (5000, 0.1), (37, 0.05)):
+        alice_bits, bob_bits = _noisy(rng, n, qber)
+        errors = int(np.count_nonzero(alice_bits != bob_bits))
+        alice, bob, round_trips = reconcile(alice_bits, bob_bits, block_size(max(qber, 0.01)), seed=n)
+        assert np.array_equal(bob.bits, alice_bits), (n, qber)
+        # both sides agree on what was corrected and disclosed
+        assert alice.corrected == bob.corrected == errors and alice.leaked == bob.leaked
+        assert np.array_equal(alice.bits, alice_bits) # Alice's key is not changed
+        assert alice.digest() == bob.digest() and np.array_equal(alice.amplify(), bob.amplify())
+        assert len(bob.amplify()) == bob.secure_len(AMPLIFY_MARGIN) // 8 * 8
+    assert bob.secure_len() < n * (1 - entropy(bob.qber()))
+    # BB84 over socket: noise is corrected, intercept-resend of every qubit gives QBER 25% and no key
+    import socket, threading
+    from BB84 import Channel
+    from client import Q_Key_Exchange
+    for channel, ok in ((Channel(noise=0.03), True), (Channel(eve=1.0), False)):
+        a, b = socket.socketpair()
+        results = []
+        def alice():
+            try:
+                results.append(Q_Key_Exchange(a, verbose=False).do_alice_part())
+            except ConnectionError:
+                results.append(None)
+        thread = threading.Thread(target=alice)
+        thread.start()
+        try:
+            key = Q_Key_Exchange(b, verbose=False, channel=channel).do_bob_part()
+        except ConnectionError:
+            key = None
+        thread.join()
+        a.close()
+        b.close()
+        assert results == [key] and (key is not None) == ok
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()
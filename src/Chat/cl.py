@@ -4,7 +4,10 @@ import socket
 import threading
 from sys import argv
 
-from client import Client, Q_Key_Exchange
+from client import Client, FrameReader, RSA_KEY_LEN
+from keypool import KeyPool
+import qkd_store
+import session
 from AES_lib import gen_key
 
 stop = False
@@ -16,6 +19,10 @@ def receive(server: Client, nickname: str):
             # Receive Message From Server
             message = server.recv()
             print(message)
+        except ConnectionError as err:
+            print(f"Connection closed: {err}")
+            server.close()
+            break
         except:
             # Close Connection When Error
             print("An error occured!")
@@ -36,6 +43,9 @@ nickname = input("Choose your nickname: ")
 
 server_sock = ['127.0.0.1', 55555]
 
+KEY_CACHE = "keypool.cache" # ready RSA keys, so the next start doesn't wait for prime search
+TICKET_FILE = "session.ticket" # -r: ticket for resuming session after reconnect
+
 # if len(sys.argv) > 2:
 #     server_sock[1] = sys.argv[1]
 # if len(sys.argv) > 2:
@@ -47,12 +57,24 @@ sock.connect(tuple(server_sock))
 
 
 key = None
-if '-q' in sys.argv:
-    key = gen_key(Q_Key_Exchange(sock).do_bob_part())
+reader = FrameReader(sock)
+# -q: key link, BB84 sessions with the server run on it in background
+link = qkd_store.open_link(tuple(server_sock)) if '-q' in sys.argv else None
+store = session.TicketStore(TICKET_FILE) if '-r' in sys.argv else None
+if store is not None:
+    key = session.client_resume(sock, reader, store)
+if key is not None:
+    key = gen_key(key)
 else:
-    key = Client.get_key(sock)
+    if link is not None:
+        key = gen_key(qkd_store.client_key(sock, reader, link))
+    else:
+        pool = KeyPool(RSA_KEY_LEN, low=1, high=2, cache_path=KEY_CACHE)
+        key = Client.get_key(sock, reader, pool)
+    if store is not None:
+        session.client_store(reader, key, store)
 
-server = Client(key, sock)
+server = Client(key, sock, reader, keys=link and link.take)
 server.send(nickname)
 
 receive_thread = threading.Thread(target=receive, args=(server, nickname))
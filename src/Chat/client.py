@@ -1,76 +1,299 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+import metrics
 from AES_lib import *
-from RSA import RSA
+from RSA import RSA, PUBLIC_EXPONENT
 from keccak import sha3_256
-from BB84 import BB84_User
+from BB84 import BB84_User, np, pack_bases, unpack_bases, pack_states, unpack_states, pack_bits, unpack_bits
+if np is not None:
+    from BB84 import NumpyBB84_User, bases_to_str, states_to_str, bits_to_str, bits_from_str
+    from cascade import Cascade, block_size, entropy, AMPLIFY_MARGIN, VERIFY_LEN
 
 RSA_KEY_LEN = 512
+HASH_LEN = 256 // 8
+QKD_PACKED = True # BB84 states, bases and bits are sent bit-packed, not as text
+BB84_KEEP_RATE = 0.6  # part of sifted bits left after the check, until it is measured
+BB84_MARGIN = 0.2     # batch is this much bigger than expected to be enough
+BB84_MIN_BATCH = 16
+BB84_MAX_BATCHES = 64
+QKD_CASCADE = True    # with numpy: Cascade reconciliation and privacy amplification instead of the check
+QBER_PRIOR = 0.02     # error rate for the first Cascade block size, until it is measured
+QBER_MAX = 0.11       # with more errors no secure key is left in BB84, the exchange is aborted
+CASCADE_LEAK = 1.25   # bits disclosed by Cascade per bit of Shannon limit n*h(QBER), about
+CASCADE_SEED = struct.Struct(">Q")
+
+FRAME_HEADER = struct.Struct(">I") # length of frame payload
+MAX_FRAME_LEN = 1 << 28
+RECV_BUFFER_LEN = 1 << 16
+REKEY_MARK = b"K"
+REKEY_FRAME_LEN = len(REKEY_MARK) + AES_BLOCK_LEN + HASH_LEN # regular frames are whole blocks and hash
+MESSAGE_CHANGED = "The message was changed during transmission! For security reasons, the message can not be decrypted."
+
+
+@metrics.timed("socket.send", size=lambda args: sum(memoryview(part).nbytes for part in args[1]))
+def send_parts(sock, parts):
+    '''
+        Send buffers one after another by vectored sendmsg, without joining them
+    '''
+    if not hasattr(sock, "sendmsg"): # Windows
+        sock.sendall(b"".join(parts))
+        return
+    parts = [memoryview(part).cast("B") for part in parts]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts:
+            parts[0] = parts[0][sent:]
+
+
+def send_frame(sock, *payload):
+    '''
+        Send payload parts as one frame with length prefix
+    '''
+    header = FRAME_HEADER.pack(sum(memoryview(part).nbytes for part in payload))
+    send_parts(sock, [header, *payload])
+
+
+class FrameReader:
+    '''
+        Reads length-prefixed frames through one reusable buffer.
+        One recv_into may bring several frames, they are then returned without new syscalls
+    '''
+    def __init__(self, sock, buffer_len: int = RECV_BUFFER_LEN):
+        self.sock = sock
+        self.buffer = bytearray(buffer_len)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0 # unread data is buffer[start:end]
+
+    def _ensure(self, n: int):
+        '''
+            Receive until at least n unread bytes are in buffer
+        '''
+        while self.end - self.start < n:
+            if self.start + n > len(self.buffer):
+                unread = self.end - self.start
+                if n > len(self.buffer): # grow for large frame
+                    buffer = bytearray(max(n, 2 * len(self.buffer)))
+                    buffer[:unread] = self.view[self.start:self.end]
+                    self.buffer, self.view = buffer, memoryview(buffer)
+                else: # move unread data to the front
+                    self.buffer[:unread] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, unread
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:
+                raise ConnectionError("connection closed")
+            metrics.add("socket.recv", received)
+            self.end += received
+
+    def read_exact(self, n: int):
+        '''
+            Return memoryview of next n bytes, valid until next read
+        '''
+        self._ensure(n)
+        res = self.view[self.start:self.start+n]
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return res
+
+    def read_frame(self):
+        '''
+            Return memoryview of next frame payload, valid until next read
+        '''
+        (length,) = FRAME_HEADER.unpack(self.read_exact(FRAME_HEADER.size))
+        if length > MAX_FRAME_LEN:
+            raise ConnectionError(f"frame of {length} bytes is too long")
+        return self.read_exact(length)
+
 
 class Client:
-    def __init__(self, key, sock):
+    def __init__(self, key, sock, reader=None, keys=None):
         '''
             Create key and save socket for connection
+            reader - FrameReader used during key exchange, it may already hold received data
+            keys - function returning key by its number, for rekeying started by the other side
         '''
         self.key = key
-        self.aes = AES128(key)
+        self.aes = AES128(key)      # sending
+        self.recv_aes = self.aes    # receiving, differs from sending one during rekeying
+        self.key_time = time.monotonic()
+        self.rekey_number = None    # number of key of rekeying started by this side
+        self.keys = keys
+        self.peer = None            # id of key link of client, see qkd_store
         self.sock = sock
+        self.reader = reader or FrameReader(sock)
+        self.send_lock = threading.Lock() # frames from different threads must not interleave
     
     def set_nickname(self, name):
         self.nick = name
 
+    def _seal(self, text: str, offset: int):
+        sb = bytes(text, 'utf-8')
+        # chifertext with whole PKCS#7 padding and its hash are written to one buffer after offset bytes,
+        # without intermediate copies
+        cipher_len = encrypt_buffer_len(len(sb))
+        frame = bytearray(offset + cipher_len + HASH_LEN)
+        view = memoryview(frame)[offset:]
+        self.aes.encrypt_into(sb, view)
+        view[cipher_len:] = sha3_256(view[:cipher_len])
+        return frame
+
     def encrypt(self, text: str):
         '''
-            Encrypt string, using key of client. Lenght of the message is placed before chifertext
+            Encrypt string, using key of client. Hash of chifertext is placed after it
+        '''
+        return self._seal(text, 0)
+
+    @metrics.timed("client.seal", size=1)
+    def seal(self, text: str):
+        '''
+            Encrypt string, return chifertext and its hash as separate buffers for send_sealed
         '''
         sb = bytes(text, 'utf-8')
-        cipher = self.aes.encrypt(sb)
-        hash_value = bytes(sha3_256(cipher))
-        new_value = cipher + hash_value
-        return new_value
-        # return self.aes.encrypt(sb)y
+        chifertext = bytearray(encrypt_buffer_len(len(sb)))
+        self.aes.encrypt_into(sb, chifertext)
+        return chifertext, sha3_256(chifertext)
+
+    def send_sealed(self, chifertext, tag):
+        '''
+            Send result of seal as one frame
+        '''
+        with self.send_lock:
+            send_frame(self.sock, chifertext, tag)
+
+    @metrics.timed("client.encrypt", size=1)
+    def encrypt_frame(self, text: str):
+        '''
+            Encrypted message with length prefix, ready to be sent
+        '''
+        frame = self._seal(text, FRAME_HEADER.size)
+        FRAME_HEADER.pack_into(frame, 0, len(frame) - FRAME_HEADER.size)
+        return frame
     
+    @metrics.timed("client.decrypt", size=1)
     def decrypt(self, sb: bytes):
         '''
-            Decrypt bytes, using key of client, and getting lenght from start of the message
+            Decrypt bytes, using key of client, length of text is given by PKCS#7 padding
         '''
-        # return str(self.aes.decrypt(sb), 'utf-8')
-        if bytes(sha3_256(sb[:-32])) == sb[-32:]:
-            return str(self.aes.decrypt(sb[:-32]), 'utf-8')
-        else:
-            return "The message was changed during transmission! For security reasons, the message can not be decrypted."
+        view = memoryview(sb)
+        cipher_len = len(view) - HASH_LEN
+        # hash is checked first, then whole blocks and utf-8: a bad frame must not raise in the server loop
+        if cipher_len <= 0 or sha3_256(view[:-HASH_LEN]) != view[-HASH_LEN:] or cipher_len % AES_BLOCK_LEN:
+            return MESSAGE_CHANGED
+        text = bytearray(cipher_len)
+        length = self.recv_aes.decrypt_into(view[:-HASH_LEN], text)
+        try:
+            return str(memoryview(text)[:length], 'utf-8')
+        except UnicodeDecodeError:
+            return MESSAGE_CHANGED
     
     def send(self, text):
         '''
             Send to socket encypted message
         '''
-        self.sock.send(self.encrypt(text))
+        with self.send_lock: # encrypted under the lock, so it can't be sent after rekeying
+            send_parts(self.sock, [self.encrypt_frame(text)])
 
     def recv(self):
         '''
             Wait for message from socket and decrypt it
         '''
-        return self.decrypt(self.sock.recv(1024))
+        while True:
+            text = self.open(self.reader.read_frame())
+            if text is not None:
+                return text
+
+    def open(self, frame):
+        '''
+            Decrypt received frame, None for rekeying frame.
+            ConnectionError if rekeying frame can't be applied: the other side has switched its key already
+        '''
+        if len(frame) != REKEY_FRAME_LEN:
+            return self.decrypt(frame)
+        view = memoryview(frame)[len(REKEY_MARK):]
+        if sha3_256(view[:-HASH_LEN]) != view[-HASH_LEN:]:
+            raise ConnectionError("rekeying frame was changed during transmission")
+        number = self.decrypt(view)
+        if not number.isdigit():
+            raise ConnectionError("rekeying frame has no key number")
+        number = int(number)
+        if number == self.rekey_number: # the other side has switched too
+            self.recv_aes = self.aes
+            self.rekey_number = None
+        else:
+            if self.keys is None:
+                raise ConnectionError("rekeying without key link")
+            key = self.keys(number) # ConnectionError if there is no such block
+            self.recv_aes = AES128(key)
+            self.rekey(number, key, answer=True) # switch sending key as well
+        return None
+
+    def rekey_frame(self, number: int, key, answer: bool = False):
+        '''
+            Switch sending key to key of number, return frame to send before any frame
+            encrypted with the new key. The other side answers with the same frame when it
+            has switched, till then received frames are decrypted with the old key.
+            Rekeying is started by one side of connection only (server)
+        '''
+        frame = self._seal(str(number), FRAME_HEADER.size + len(REKEY_MARK))
+        FRAME_HEADER.pack_into(frame, 0, len(frame) - FRAME_HEADER.size)
+        frame[FRAME_HEADER.size:FRAME_HEADER.size + len(REKEY_MARK)] = REKEY_MARK
+        self.key = key
+        self.aes = AES128(key)
+        self.key_time = time.monotonic()
+        if not answer:
+            self.rekey_number = number
+        metrics.add("client.rekey")
+        return frame
+
+    def rekey(self, number: int, key, answer: bool = False):
+        '''
+            Send rekey_frame. Frames encrypted by other threads outside send_lock
+            (FanOut) must not be in flight
+        '''
+        with self.send_lock:
+            send_parts(self.sock, [self.rekey_frame(number, key, answer)])
    
     def close(self):
         self.sock.close()
 
+    @metrics.timed("handshake.rsa_wrap")
     def key_exchange(self):
         '''
-            Recieve public key, encrypt AES key and send it
+            Recieve public key, encrypt AES key in one packed RSA block and send it
         '''
-        n = int.from_bytes(self.sock.recv(RSA_KEY_LEN), "big")
-        e = int.from_bytes(self.sock.recv(RSA_KEY_LEN), "big")
+        public = self.reader.read_frame()
+        half = len(public) // 2
+        if half == 0 or len(public) % 2:
+            raise ConnectionError("wrong public key")
+        n = int.from_bytes(public[:half], "big")
+        e = int.from_bytes(public[half:], "big")
         byte_key = bytes(i for i in self.key)
-        self.sock.send(RSA(n, e=e).encrypt(byte_key))
+        send_frame(self.sock, RSA(n, e=e).encrypt(byte_key, packed=True))
 
     @staticmethod
-    def get_key(sock):
+    @metrics.timed("handshake.rsa_client")
+    def get_key(sock, reader=None, pool=None):
         '''
-            Send public key, recieve encrypted AES key and decrypt it
+            Send public key as one frame of n and e, both of modulus length, recieve encrypted AES key and decrypt it
+            reader - FrameReader to pass later to Client, so no received data is lost
+            pool - KeyPool with ready RSA keys, otherwise key is generated here
         '''
-        n, e, d = RSA.generate_key(RSA_KEY_LEN)
-        sock.send(n.to_bytes(RSA_KEY_LEN, "big"))
-        sock.send(e.to_bytes(RSA_KEY_LEN, "big"))
-        key = RSA(n, e=e, d=d).decrypt(sock.recv(AES_KEY_LEN * RSA_KEY_LEN))
+        if pool is not None:
+            n, e, d, p, q = pool.get()
+        else:
+            n, e, d, p, q = RSA.generate_key(RSA_KEY_LEN, with_primes=True)
+        rsa = RSA(n, e=e, d=d, p=p, q=q)
+        send_frame(sock, n.to_bytes(rsa.len_n(), "big"), e.to_bytes(rsa.len_n(), "big"))
+        key = rsa.decrypt(bytes((reader or FrameReader(sock)).read_frame()), packed=True)
+        if len(key) != AES_KEY_LEN:
+            raise ConnectionError("wrong AES key")
         return gen_key([*key])
     
 
@@ -82,103 +305,419 @@ def str_to_list_int(s: str):
 
 class Q_Key_Exchange:
     '''
-        Imitation of quantum key exchange using BB84 protocol
+        Imitation of quantum key exchange using BB84 protocol.
+        Key is collected from batches of qubits: every batch which passes the check adds its key bits,
+        size of the next batch is estimated from sift and error rates of the previous ones.
+        Per batch Alice sends qubits and bases, Bob answers with his bases, compared positions and check bits,
+        Alice sends her check bits together with qubits of the next batch, so one batch costs one round-trip.
+        Both sides check the same bits, so they stop after the same batch without extra messages.
+        With numpy and QKD_CASCADE the check is replaced by Cascade (see cascade.py): Bob corrects
+        errors of the whole sifted key and sends its hash with his last answer, Alice sends the verdict
+        with qubits of the next batch, and the key is shortened by what Eve may know (privacy amplification)
     '''
-    def __init__(self, sock, need_bytes: int = AES_KEY_LEN):
+    def __init__(self, sock, need_bytes: int = AES_KEY_LEN, reader=None, user=None, verbose: bool = True,
+                 channel=None):
         '''
             Save socket for connection
             After key preparation get key of "need_bytes" bytes
+            user - BB84_User or NumpyBB84_User (default, if numpy is installed)
+            verbose - print batch sizes and key
+            channel - BB84.Channel applied by Bob to received qubits, NumpyBB84_User only
         '''
+        self.verbose = verbose
         self.sock = sock
+        self.reader = reader or FrameReader(sock)
         self.need_bytes = need_bytes
-    
+        self.user = user or (BB84_User if np is None else NumpyBB84_User)
+        self.arrays = self.user is not BB84_User
+        self.cascade = np is not None and QKD_CASCADE # both sides must agree, as on QKD_PACKED
+        self.channel = channel
+        self.out = []        # frames of the current flight
+        self.key_parts = []  # key bits of kept batches
+        self.missing = need_bytes * 8
+        self.batches = 0
+        self.sent = self.sifted = 0       # qubits of all batches and their part measured in the same bases
+        self.sifted_kept = self.kept = 0  # sifted bits of kept batches and key bits left after the check
+        self.checked = self.errors = 0    # compared bits and mismatches among them
+        self.leaked = 0                   # bits disclosed by Cascade
+        # key bits of a reconciled batch are about keep_rate * sifted - overhead: hash and margin of amplification
+        self.overhead = VERIFY_LEN * 8 + AMPLIFY_MARGIN if self.cascade else 0
+
+    def queue(self, *payload):
+        '''
+            Add frame to the current flight, it is sent by flush() or before the next receive
+        '''
+        self.out += [FRAME_HEADER.pack(sum(memoryview(part).nbytes for part in payload)), *payload]
+
+    def flush(self):
+        if self.out:
+            send_parts(self.sock, self.out)
+            self.out = []
+
+    def read_frame(self):
+        self.flush()
+        return self.reader.read_frame()
+
     def send(self, text):
         '''
             Send to socket plaintext
         '''
-        self.sock.send(bytes(text, "utf-8"))
+        self.queue(bytes(text, "utf-8"))
 
-    def recv(self, n: int):
+    def recv(self):
         '''
-            Wait for message from socket and decrypt it
+            Wait for message from socket
         '''
-        return str(self.sock.recv(n), "utf-8")
-    
+        return str(self.read_frame(), "utf-8")
+
+    # Bit-packed messages of BB84 (see BB84.pack_*), or text of BB84_User if QKD_PACKED is off:
+    # then NumpyBB84_User arrays are converted to text and back
+    def send_bits(self, bits):
+        if QKD_PACKED:
+            self.queue(pack_bits(bits))
+        else:
+            self.send(bits_to_str(bits) if self.arrays else list_int_to_str(bits))
+
+    def recv_bits(self):
+        if QKD_PACKED:
+            return unpack_bits(self.read_frame(), text=not self.arrays)
+        return bits_from_str(self.recv()) if self.arrays else str_to_list_int(self.recv())
+
+    def send_bases(self, bases):
+        if QKD_PACKED:
+            self.queue(pack_bases(bases))
+        else:
+            self.send(bases_to_str(bases) if self.arrays else bases)
+
+    def recv_bases(self):
+        if QKD_PACKED:
+            return unpack_bases(self.read_frame(), text=not self.arrays)
+        return self.recv()
+
+    def send_states(self, states):
+        if QKD_PACKED:
+            self.queue(pack_states(states))
+        else:
+            self.send(states_to_str(states) if self.arrays else states)
+
+    def recv_states(self):
+        if QKD_PACKED:
+            return unpack_states(self.read_frame(), text=not self.arrays)
+        return self.recv()
+
+    def batch_size(self):
+        '''
+            Number of qubits expected to give the missing key bits with BB84_MARGIN to spare
+        '''
+        sift_rate = self.sifted / self.sent if self.sent else 0.5
+        if self.cascade:
+            # Eve's knowledge and disclosed parities are removed, and hash and margin of every batch
+            keep_rate = max(0.05, 1 - (1 + CASCADE_LEAK) * entropy(self.qber()))
+        else:
+            keep_rate = self.kept / self.sifted_kept if self.sifted_kept else BB84_KEEP_RATE
+        n = int((self.missing + self.overhead) / (sift_rate * keep_rate) * (1 + BB84_MARGIN)) + BB84_MIN_BATCH
+        if self.errors and not self.cascade:
+            # batch is kept only without mismatches: with errors in the channel bigger batch is more likely
+            # to be thrown away, so it is limited to about one expected mismatch
+            qber = self.errors / self.checked
+            n = min(n, BB84_MIN_BATCH + int(self.sent / (self.checked * qber)))
+        return n
+
+    def send_batch(self):
+        '''
+            Start the next batch: queue its size, qubits and Alice's bases
+        '''
+        n = self.batch_size()
+        if self.verbose:
+            print("START: " + str(n))
+        alice = self.user(n, True)
+        self.send(str(n))
+        self.send_states(alice.get_sends()) # send states (qubits)
+        self.send_bases(alice.bases)
+        return alice
+
+    def keep_batch(self, user, chosen_compare, own_check_bits, another_check_bits):
+        '''
+            Compare check bits of sifted batch, keep its key if they are equal.
+            Return True when enough key is collected
+        '''
+        sifted = len(user.key)
+        if self.arrays:
+            errors = int(np.count_nonzero(np.asarray(own_check_bits) != np.asarray(another_check_bits)))
+        else:
+            errors = sum(x != y for x, y in zip(own_check_bits, another_check_bits))
+        key = user.key if user.check(chosen_compare, another_check_bits) else None
+        return self.count_batch(user, sifted, len(own_check_bits), errors, key)
+
+    def keep_reconciled(self, user, cascade, ok: bool):
+        '''
+            Keep amplified key of reconciled batch if hashes of keys are equal, abort on QBER above QBER_MAX.
+            Return True when enough key is collected
+        '''
+        self.leaked += cascade.leaked
+        if cascade.qber() > QBER_MAX:
+            self.flush() # the verdict, the peer stops too
+            raise ConnectionError(f"BB84: QBER {cascade.qber():.3f} of batch is above {QBER_MAX}, "
+                                  "the channel is eavesdropped")
+        key = cascade.amplify() if ok else None
+        return self.count_batch(user, cascade.n, cascade.n, cascade.corrected, key)
+
+    def count_batch(self, user, sifted: int, checked: int, errors: int, key):
+        '''
+            Add batch to statistics and its key (None if thrown away) to collected one.
+            Return True when enough key is collected
+        '''
+        metrics.add("bb84.batches")
+        self.batches += 1
+        self.sent += len(user.bases)
+        self.sifted += sifted
+        self.checked += checked
+        self.errors += errors
+        if key is not None and len(key): # amplification may leave nothing of a small batch
+            self.key_parts.append(key)
+            self.sifted_kept += sifted
+            self.kept += len(key)
+            self.missing -= len(key)
+        if self.missing <= 0:
+            return True
+        if self.batches >= BB84_MAX_BATCHES:
+            self.flush() # the last check bits or verdict, the peer stops too
+            raise ConnectionError(f"BB84: key is not collected in {self.batches} batches, "
+                                  f"{self.errors} of {self.checked} checked bits differ")
+        return False
+
+    def qber(self):
+        return self.errors / self.checked if self.checked else QBER_PRIOR
+
+    @metrics.timed("bb84.cascade", size=lambda args: len(args[1].key) // 8)
+    def reconcile(self, user, seed: int, alice: bool):
+        '''
+            Cascade on sifted key of the batch. Bob sends block parities together with his bases,
+            Alice answers which blocks differ and first halves of searches, then one round-trip per halving.
+            Bob's hash of corrected key goes with his last answer, or already with parities while no errors
+            were seen: then a batch without errors costs no more flights than the check.
+            Return Cascade and whether keys are equal, the same on both sides
+        '''
+        cascade = Cascade(np.asarray(user.key, np.uint8), block_size(self.qber()), seed, correct=not alice)
+        early = self.errors == 0 # Bob sends hash with parities
+        if alice:
+            mismatch = cascade.parities() ^ np.asarray(self.recv_bits(), np.uint8)
+            digest = self.read_frame() if early else None
+            self.send_bits(mismatch)
+        else:
+            self.send_bits(cascade.parities())
+            if early:
+                self.queue(cascade.digest())
+            mismatch = self.recv_bits()
+        cascade.set_mismatch(mismatch)
+        searched = not cascade.done()
+        while not cascade.done():
+            if alice:
+                self.send_bits(cascade.half_parities())
+                cascade.narrow(self.recv_bits())
+            else:
+                choices = (cascade.half_parities() == np.asarray(self.recv_bits(), np.uint8)).view(np.uint8)
+                self.send_bits(choices)
+                cascade.narrow(choices)
+        if alice:
+            if searched or not early:
+                if early:
+                    cascade.digest() # hash of Bob's key before corrections is disclosed too
+                digest = self.read_frame()
+            ok = cascade.digest() == digest
+            self.queue(bytes([ok])) # verdict goes with the next batch
+        else:
+            if searched or not early:
+                self.queue(cascade.digest()) # in the same flight with the last answer
+            ok = self.read_frame() == b"\x01"
+        return cascade, ok
+
+    def key_bits(self):
+        if self.arrays:
+            return np.concatenate(self.key_parts)
+        return [x for part in self.key_parts for x in part]
+
     def form_byte_key(self, bit_key: list[int]):
         if len(bit_key)//8 < self.need_bytes:
             return None
-        return [sum(bit_key[8*i+j]*2**j for j in range(8)) for i in range(self.need_bytes)] 
+        if self.arrays:
+            return np.packbits(bit_key[:8*self.need_bytes], bitorder="little").tolist()
+        return [sum(int(bit_key[8*i+j])*2**j for j in range(8)) for i in range(self.need_bytes)] 
 
+    @metrics.timed("handshake.bb84_alice")
     def do_alice_part(self) -> bytes:
         '''
             Alice's (leader) side of the protocol
         '''
-        n = self.need_bytes * 8 * 4 # required number of bits with possible 75% key loss
+        alice = self.send_batch()
         while True:
-            print("START: " + str(n))
-            self.send(str(n))
-            alice = BB84_User(n, True)
-
-            # === Quantum channel   ===
-            self.send(alice.get_sends()) # send states (qubits)
-
             # === Classical channel ===
-            # exchange bases
-            self.send(alice.bases)
-            bob_bases = self.recv(3*n) # each symbol up to 3 bytes
-
+            bob_bases = self.recv_bases()
             alice.get_key(bob_bases) # form the key
 
-            # Key error check
-            chosen_compare = alice.get_chosen_compare(alice.n//2)
-            self.send(list_int_to_str(chosen_compare))
-            bob_check_bits = str_to_list_int(self.recv(n))
+            if self.cascade:
+                # Error correction, Bob has chosen permutations of passes and sent block parities
+                (seed,) = CASCADE_SEED.unpack(self.read_frame())
+                if self.keep_reconciled(alice, *self.reconcile(alice, seed, alice=True)):
+                    break
+                alice = self.send_batch() # goes in the same flight with the verdict
+                continue
 
+            # Key error check, Bob has chosen bits to compare
+            chosen_compare = self.recv_bits()
+            bob_check_bits = self.recv_bits()
             alice_check_bits = alice.get_check_bits(chosen_compare)
-            self.send(list_int_to_str(alice_check_bits))
-
-            key = None
-            if alice.check(chosen_compare, bob_check_bits):
-                key = self.form_byte_key(alice.key)
-            
-            if self.recv(5) == 'OK' and key:
-                self.send('END')
-                print(list_int_to_str(alice.key))
-                return key
-            n = int(n*1.5) # increase number of qubits because of it's possible shortage
-            self.send('NEW') # new try
+            self.send_bits(alice_check_bits)
+
+            if self.keep_batch(alice, chosen_compare, alice_check_bits, bob_check_bits):
+                break
+            alice = self.send_batch() # goes in the same flight with check bits
+        self.flush()
+        bit_key = self.key_bits()
+        if self.verbose:
+            print(bits_to_str(bit_key) if self.arrays else list_int_to_str(bit_key))
+        return self.form_byte_key(bit_key)
 
+    @metrics.timed("handshake.bb84_bob")
     def do_bob_part(self) -> bytes:
         '''
             Bob's (follower) side of the protocol  
         '''
         while True:
-            n = int(self.recv(20))
-            bob = BB84_User(n, False)
+            n = int(self.recv())
+            bob = self.user(n, False)
 
             # === Quantum channel   ===
-            bob.get_observations(self.recv(3*n)) # recieve and measure qubits 
+            states = self.recv_states()
+            if self.channel is not None:
+                states = self.channel(states) # noise and eavesdropping
+            bob.get_observations(states) # recieve and measure qubits 
 
             # === Classical channel ===
             # exchange bases
-            alice_bases = self.recv(3*n) # each symbol up to 3 bytes
-            self.send(bob.bases)
-
+            alice_bases = self.recv_bases()
+            self.send_bases(bob.bases)
             bob.get_key(alice_bases)  # form the key
 
+            if self.cascade:
+                # Error correction
+                seed = int.from_bytes(os.urandom(CASCADE_SEED.size), "big")
+                self.queue(CASCADE_SEED.pack(seed)) # in the same flight with bases
+                if self.keep_reconciled(bob, *self.reconcile(bob, seed, alice=False)):
+                    break
+                continue
+
             # Key error check
-            chosen_compare = str_to_list_int(self.recv(n))
+            chosen_compare = bob.get_chosen_compare(bob.n//2)
             bob_check_bits = bob.get_check_bits(chosen_compare)
-            self.send(list_int_to_str(bob_check_bits))
-
-            alice_check_bits = str_to_list_int(self.recv(n))
-            
-            key = None
-            if bob.check(chosen_compare, alice_check_bits):
-                key = self.form_byte_key(bob.key)
-            
-            self.send('OK' if key else 'ERROR')
-            if self.recv(5) == 'END':
-                print(list_int_to_str(bob.key))
-                return key
-                
\ No newline at end of file
+            self.send_bits(chosen_compare)
+            self.send_bits(bob_check_bits)
+            alice_check_bits = self.recv_bits()
+
+            if self.keep_batch(bob, chosen_compare, bob_check_bits, alice_check_bits):
+                break
+        bit_key = self.key_bits()
+        if self.verbose:
+            print(bits_to_str(bit_key) if self.arrays else list_int_to_str(bit_key))
+        return self.form_byte_key(bit_key)
+                
+
+def benchmark(count: int = 20):
+    '''
+        RSA handshake over socketpair with random and fixed public exponent.
+        Keys are generated beforehand, so only key wrap on server and unwrap on client are timed
+    '''
+    import time
+    from keypool import KeyPool
+    for name, exponent in (("random e", None), (f"e={PUBLIC_EXPONENT}", PUBLIC_EXPONENT)):
+        pool = KeyPool(RSA_KEY_LEN, low=0, high=count)
+        pool.keys = [RSA.generate_key(RSA_KEY_LEN, with_primes=True, e=exponent) for _ in range(count)]
+        wrap_time = handshake_time = 0
+        for _ in range(count):
+            a, b = socket.socketpair()
+            server = Client(gen_key(), a)
+            def wrap():
+                nonlocal wrap_time
+                # public key frame is received, only wrap is timed
+                server.reader._ensure(FRAME_HEADER.size + 2 * (RSA_KEY_LEN // 8))
+                start = time.perf_counter()
+                server.key_exchange()
+                wrap_time += time.perf_counter() - start
+            thread = threading.Thread(target=wrap)
+            thread.start()
+            start = time.perf_counter()
+            assert bytes(Client.get_key(b, pool=pool)) == bytes(server.key)
+            handshake_time += time.perf_counter() - start
+            thread.join()
+            a.close()
+            b.close()
+        pool.close()
+        print(f"{name:>9}: server wrap {wrap_time/count*1000:8.3f} ms, handshake {handshake_time/count*1000:8.3f} ms")
+
+def benchmark_bb84(count: int = 20, sizes=(AES_KEY_LEN, 1024), latencies=(0, 0.005), noises=(0, 0.03)):
+    '''
+        BB84 exchange over socketpair with text and bit-packed messages: bytes sent by both sides,
+        round-trips and time per key. latencies - simulated one-way delays of link, in seconds,
+        noises - part of qubits flipped by the channel (with numpy), measured QBER and Cascade leak are shown
+    '''
+    import contextlib, io, time
+    from BB84 import Channel
+    global QKD_PACKED
+    packed_default = QKD_PACKED
+
+    class Link:
+        # socket for send_parts, counts bytes and changes of direction, delays every flight by latency
+        last = None
+        def __init__(self, sock, latency):
+            self.sock = sock
+            self.latency = latency
+            self.sent = 0
+            self.turns = 0
+        def sendall(self, data):
+            if Link.last is not self:
+                Link.last = self
+                self.turns += 1
+                time.sleep(self.latency)
+            self.sock.sendall(data)
+            self.sent += len(data)
+
+    for noise in noises if np is not None else (0,):
+        for latency in latencies:
+            for need_bytes in sizes:
+                for QKD_PACKED in (False, True):
+                    sent = turns = total = errors = checked = leaked = 0
+                    for _ in range(count):
+                        a, b = socket.socketpair()
+                        alice, bob = Link(a, latency), Link(b, latency)
+                        keys = []
+                        thread = threading.Thread(target=lambda: keys.append(
+                            Q_Key_Exchange(alice, need_bytes, FrameReader(a)).do_alice_part()))
+                        exchange = Q_Key_Exchange(bob, need_bytes, FrameReader(b),
+                                                  channel=Channel(noise) if noise else None)
+                        start = time.perf_counter()
+                        with contextlib.redirect_stdout(io.StringIO()): # keys are printed
+                            thread.start()
+                            key = exchange.do_bob_part()
+                            thread.join()
+                        total += time.perf_counter() - start
+                        assert keys == [key]
+                        sent += alice.sent + bob.sent
+                        turns += alice.turns + bob.turns
+                        errors += exchange.errors
+                        checked += exchange.checked
+                        leaked += exchange.leaked
+                        Link.last = None
+                        a.close()
+                        b.close()
+                    print(f"noise {noise:4.2f}, latency {latency*1000:4.1f} ms, {need_bytes:>5} byte key, "
+                          f"{'packed' if QKD_PACKED else 'text':>6}: {sent/count:10.0f} bytes, "
+                          f"{turns/count/2:5.1f} round-trips, {total/count*1000:8.3f} ms, "
+                          f"QBER {errors/checked:.4f}, leaked {leaked/count:7.0f} bits")
+    QKD_PACKED = packed_default
+
+if __name__ == "__main__":
+    import sys
+    if '--bench' in sys.argv:
+        benchmark()
+    if '--bench-bb84' in sys.argv:
+        benchmark_bb84()
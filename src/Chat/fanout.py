@@ -0,0 +1,254 @@
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from AES_lib import AES128, encrypt_buffer_len
+from keccak import sha3_256, sha3_256_many
+
+FANOUT_WORKERS = os.cpu_count() or 4
+WORKER_KEYS = 1024 # AES objects cached in one worker process
+BATCH_MIN_RECIPIENTS = 16 # smaller rooms are served one by one in batch mode, NumPy call costs more than it saves
+
+# Mode used by default, FANOUT_MODE environment variable may name another
+try:
+    import numpy
+    default_mode = "batch"
+except ImportError:
+    default_mode = "thread"
+default_mode = os.environ.get('FANOUT_MODE') or default_mode
+
+
+class FanOutMetrics:
+    '''
+        Counters of broadcast pipeline, read by snapshot()
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0       # broadcast calls
+        self.deliveries = 0     # frames sent
+        self.errors = 0         # failed sends
+        self.queue_depth = 0    # deliveries submitted and not finished yet
+        self.max_queue_depth = 0
+        self.latency_total = 0.0 # seconds from broadcast start till last recipient is done
+        self.latency_max = 0.0
+
+    def submitted(self, count):
+        with self.lock:
+            self.queue_depth += count
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def done(self, ok):
+        with self.lock:
+            self.queue_depth -= 1
+            if ok:
+                self.deliveries += 1
+            else:
+                self.errors += 1
+
+    def finished(self, latency):
+        with self.lock:
+            self.messages += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "messages": self.messages,
+                "deliveries": self.deliveries,
+                "errors": self.errors,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "fanout_latency_avg": self.latency_total / self.messages if self.messages else 0.0,
+                "fanout_latency_max": self.latency_max,
+            }
+
+
+_worker_aes = {}
+
+def _seal_in_worker(key: bytes, sb: bytes):
+    '''
+        Encrypt and hash in worker process. Client objects hold sockets and ctypes pointers,
+        so only key and text are passed, AES objects are cached by key
+    '''
+    aes = _worker_aes.get(key)
+    if aes is None:
+        if len(_worker_aes) >= WORKER_KEYS:
+            _worker_aes.clear()
+        aes = _worker_aes[key] = AES128([*key])
+    chifertext = bytearray(encrypt_buffer_len(len(sb)))
+    aes.encrypt_into(sb, chifertext)
+    return bytes(chifertext), sha3_256(chifertext)
+
+def _ready():
+    pass
+
+
+class FanOut:
+    '''
+        Sends one message to many clients, each with its own key.
+        mode - "serial": encrypt, hash and send one by one in the calling thread
+               "thread": every recipient on a thread pool, native AES runs without GIL
+               "process": encryption and pure Python SHA-3 on a process pool,
+                          frames are sent from the calling thread as they are ready
+               "batch": encryption one by one, all chifertexts hashed by one NumPy sha3_256_many call,
+                        for less than batch_min recipients it works as "serial"
+        broadcast() returns when every recipient is served, so messages of one sender keep their order
+    '''
+    def __init__(self, mode: str = None, workers: int = FANOUT_WORKERS, batch_min: int = BATCH_MIN_RECIPIENTS):
+        self.mode = mode = mode or default_mode
+        self.batch_min = batch_min
+        self.metrics = FanOutMetrics()
+        self.pool = None
+        if mode == "thread":
+            self.pool = ThreadPoolExecutor(workers, thread_name_prefix="fanout")
+        elif mode == "process":
+            self.pool = ProcessPoolExecutor(workers)
+            # start workers now: forking later, from a process with running threads, is unsafe
+            self.pool.submit(_ready).result()
+        elif mode == "batch":
+            import numpy # sha3_256_many needs it, fail here and not on first message
+        elif mode != "serial":
+            raise ValueError(f"unknown fan-out mode {mode!r}")
+
+    def _deliver(self, client, text):
+        try:
+            client.send_sealed(*client.seal(text))
+            return True
+        except OSError:
+            return False
+
+    def broadcast(self, text: str, recipients):
+        '''
+            Encrypt text for every recipient and send it. Return list of recipients whose send failed
+        '''
+        recipients = list(recipients)
+        if not recipients:
+            return []
+        start = time.perf_counter()
+        self.metrics.submitted(len(recipients))
+        failed = []
+        mode = self.mode
+        if mode == "batch" and len(recipients) < self.batch_min:
+            mode = "serial"
+        if mode == "serial":
+            for client in recipients:
+                ok = self._deliver(client, text)
+                self.metrics.done(ok)
+                if not ok:
+                    failed.append(client)
+        elif mode == "thread":
+            futures = {self.pool.submit(self._deliver, client, text): client for client in recipients}
+            for future in as_completed(futures):
+                ok = future.result()
+                self.metrics.done(ok)
+                if not ok:
+                    failed.append(futures[future])
+        elif mode == "batch":
+            sb = bytes(text, 'utf-8')
+            chifertexts = []
+            for client in recipients:
+                chifertext = bytearray(encrypt_buffer_len(len(sb)))
+                client.aes.encrypt_into(sb, chifertext)
+                chifertexts.append(chifertext)
+            for client, chifertext, tag in zip(recipients, chifertexts, sha3_256_many(chifertexts)):
+                try:
+                    client.send_sealed(chifertext, tag)
+                    ok = True
+                except OSError:
+                    ok = False
+                self.metrics.done(ok)
+                if not ok:
+                    failed.append(client)
+        else:
+            sb = bytes(text, 'utf-8')
+            futures = {self.pool.submit(_seal_in_worker, bytes(client.key), sb): client for client in recipients}
+            for future in as_completed(futures):
+                client = futures[future]
+                try:
+                    client.send_sealed(*future.result())
+                    ok = True
+                except OSError:
+                    ok = False
+                self.metrics.done(ok)
+                if not ok:
+                    failed.append(client)
+        self.metrics.finished(time.perf_counter() - start)
+        return failed
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def benchmark(counts=(1, 16, 128), sizes=(64, 4096), repeat=3):
+    '''
+        Time of one broadcast to N clients connected by socketpairs, for every mode
+    '''
+    import socket
+    from AES_lib import gen_key
+    from client import Client
+    modes = {mode: FanOut(mode) for mode in ("serial", "thread", "process", "batch")}
+    for count in counts:
+        pairs = [socket.socketpair() for _ in range(count)]
+        clients = [Client(gen_key(), a) for a, b in pairs]
+        def drain(sock): # receiving side, so sends never block
+            try:
+                while sock.recv(1 << 16):
+                    pass
+            except OSError:
+                pass
+        readers = [threading.Thread(target=drain, args=(b,), daemon=True) for a, b in pairs]
+        for reader in readers:
+            reader.start()
+        for size in sizes:
+            text = "x" * size
+            line = f"{count:>4} clients {size:>5} B:"
+            for name, fanout in modes.items():
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    fanout.broadcast(text, clients)
+                    best = min(best, time.perf_counter() - start)
+                line += f"  {name} {best*1000:9.2f} ms"
+            print(line)
+        for a, b in pairs:
+            a.close()
+            b.close()
+    for fanout in modes.values():
+        print(fanout.mode, fanout.metrics.snapshot())
+        fanout.close()
+
+
+def tests():
+    import socket
+    from AES_lib import gen_key
+    from client import Client
+    pairs = [socket.socketpair() for _ in range(4)]
+    keys = [gen_key() for _ in pairs]
+    senders = [Client(key, a) for key, (a, b) in zip(keys, pairs)]
+    receivers = [Client(key, b) for key, (a, b) in zip(keys, pairs)]
+    for mode, batch_min in (("serial", 0), ("thread", 0), ("process", 0), ("batch", 1), ("batch", len(pairs) + 1)):
+        fanout = FanOut(mode, 2, batch_min)
+        for text in ("hello", "Олег is the best)" * 100, "x" * 16, "fifteen chars\0\0\x03"):
+            assert fanout.broadcast(text, senders) == [], mode
+            for receiver in receivers:
+                assert receiver.recv() == text, mode
+        snapshot = fanout.metrics.snapshot()
+        assert snapshot["deliveries"] == 4 * len(pairs) and snapshot["queue_depth"] == 0, mode
+        fanout.close()
+    # frames with valid hash but chifertext of a wrong length or not utf-8 text are reported, not raised
+    from client import MESSAGE_CHANGED
+    for chifertext in (b"x" * 17, senders[0].aes.encrypt(b"\xff" * 15 + b"\x01")):
+        assert receivers[0].decrypt(chifertext + sha3_256(chifertext)) == MESSAGE_CHANGED
+    pairs[0][1].close()
+    assert FanOut("thread").broadcast("bye", senders[:1]) == senders[:1]
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()
@@ -1,118 +1,436 @@
+from metrics import timed
+
+_MASK = (1 << 64) - 1
+
+def _gen_tables():
+    '''
+        Lane i = x + 5*y of the flat state.
+        Return (rotations, pi, round_constants), where ρ rotates lane i by rotations[i]
+        and π moves it to lane pi[i]
+    '''
+    rotations = [0]*25
+    x, y = 1, 0
+    for t in range(24):
+        rotations[x + 5*y] = (t+1)*(t+2)//2 % 64
+        x, y = y, (2*x + 3*y)%5
+
+    pi = [y + 5*((2*x + 3*y)%5) for y in range(5) for x in range(5)]
+
+    round_constants = [0]*24
+    R = 1
+    for round in range(24):
+        for j in range(7):
+            R = ((R << 1) ^ ((R >> 7) * 0x71)) % 256
+            if R & 2:
+                round_constants[round] ^= (1 << ((1 << j) - 1))
+    return tuple(rotations), tuple(pi), tuple(round_constants)
+
+_ROT, _PI, _RC = _gen_tables()
+
+def _keccak_f(state):
+    '''
+        Keccak-f[1600] permutation of the flat 25-lane state, in place.
+        θ and χ are unrolled, ρ and π are merged: b[_PI[i]] = rot(a[i] ^ d[i%5], _ROT[i])
+    '''
+    (a0, a1, a2, a3, a4, a5, a6, a7, a8, a9, a10, a11, a12,
+     a13, a14, a15, a16, a17, a18, a19, a20, a21, a22, a23, a24) = state
+    for rc in _RC:
+        # θ
+        c0 = a0 ^ a5 ^ a10 ^ a15 ^ a20
+        c1 = a1 ^ a6 ^ a11 ^ a16 ^ a21
+        c2 = a2 ^ a7 ^ a12 ^ a17 ^ a22
+        c3 = a3 ^ a8 ^ a13 ^ a18 ^ a23
+        c4 = a4 ^ a9 ^ a14 ^ a19 ^ a24
+        d0 = c4 ^ (((c1 << 1) | (c1 >> 63)) & _MASK)
+        d1 = c0 ^ (((c2 << 1) | (c2 >> 63)) & _MASK)
+        d2 = c1 ^ (((c3 << 1) | (c3 >> 63)) & _MASK)
+        d3 = c2 ^ (((c4 << 1) | (c4 >> 63)) & _MASK)
+        d4 = c3 ^ (((c0 << 1) | (c0 >> 63)) & _MASK)
+        # ρ and π
+        b0 = a0 ^ d0
+        t = a6 ^ d1; b1 = ((t << 44) | (t >> 20)) & _MASK
+        t = a12 ^ d2; b2 = ((t << 43) | (t >> 21)) & _MASK
+        t = a18 ^ d3; b3 = ((t << 21) | (t >> 43)) & _MASK
+        t = a24 ^ d4; b4 = ((t << 14) | (t >> 50)) & _MASK
+        t = a3 ^ d3; b5 = ((t << 28) | (t >> 36)) & _MASK
+        t = a9 ^ d4; b6 = ((t << 20) | (t >> 44)) & _MASK
+        t = a10 ^ d0; b7 = ((t << 3) | (t >> 61)) & _MASK
+        t = a16 ^ d1; b8 = ((t << 45) | (t >> 19)) & _MASK
+        t = a22 ^ d2; b9 = ((t << 61) | (t >> 3)) & _MASK
+        t = a1 ^ d1; b10 = ((t << 1) | (t >> 63)) & _MASK
+        t = a7 ^ d2; b11 = ((t << 6) | (t >> 58)) & _MASK
+        t = a13 ^ d3; b12 = ((t << 25) | (t >> 39)) & _MASK
+        t = a19 ^ d4; b13 = ((t << 8) | (t >> 56)) & _MASK
+        t = a20 ^ d0; b14 = ((t << 18) | (t >> 46)) & _MASK
+        t = a4 ^ d4; b15 = ((t << 27) | (t >> 37)) & _MASK
+        t = a5 ^ d0; b16 = ((t << 36) | (t >> 28)) & _MASK
+        t = a11 ^ d1; b17 = ((t << 10) | (t >> 54)) & _MASK
+        t = a17 ^ d2; b18 = ((t << 15) | (t >> 49)) & _MASK
+        t = a23 ^ d3; b19 = ((t << 56) | (t >> 8)) & _MASK
+        t = a2 ^ d2; b20 = ((t << 62) | (t >> 2)) & _MASK
+        t = a8 ^ d3; b21 = ((t << 55) | (t >> 9)) & _MASK
+        t = a14 ^ d4; b22 = ((t << 39) | (t >> 25)) & _MASK
+        t = a15 ^ d0; b23 = ((t << 41) | (t >> 23)) & _MASK
+        t = a21 ^ d1; b24 = ((t << 2) | (t >> 62)) & _MASK
+        # χ and ι
+        a0 = b0 ^ (~b1 & b2) ^ rc
+        a1 = b1 ^ (~b2 & b3)
+        a2 = b2 ^ (~b3 & b4)
+        a3 = b3 ^ (~b4 & b0)
+        a4 = b4 ^ (~b0 & b1)
+        a5 = b5 ^ (~b6 & b7)
+        a6 = b6 ^ (~b7 & b8)
+        a7 = b7 ^ (~b8 & b9)
+        a8 = b8 ^ (~b9 & b5)
+        a9 = b9 ^ (~b5 & b6)
+        a10 = b10 ^ (~b11 & b12)
+        a11 = b11 ^ (~b12 & b13)
+        a12 = b12 ^ (~b13 & b14)
+        a13 = b13 ^ (~b14 & b10)
+        a14 = b14 ^ (~b10 & b11)
+        a15 = b15 ^ (~b16 & b17)
+        a16 = b16 ^ (~b17 & b18)
+        a17 = b17 ^ (~b18 & b19)
+        a18 = b18 ^ (~b19 & b15)
+        a19 = b19 ^ (~b15 & b16)
+        a20 = b20 ^ (~b21 & b22)
+        a21 = b21 ^ (~b22 & b23)
+        a22 = b22 ^ (~b23 & b24)
+        a23 = b23 ^ (~b24 & b20)
+        a24 = b24 ^ (~b20 & b21)
+    state[:] = (a0, a1, a2, a3, a4, a5, a6, a7, a8, a9, a10, a11, a12,
+                a13, a14, a15, a16, a17, a18, a19, a20, a21, a22, a23, a24)
+
+def _keccak_f_reference(state):
+    '''
+        Straightforward table-driven Keccak-f[1600], used to check _keccak_f
+    '''
+    for rc in _RC:
+        C = [state[x] ^ state[x+5] ^ state[x+10] ^ state[x+15] ^ state[x+20] for x in range(5)]
+        D = [C[(x+4)%5] ^ (((C[(x+1)%5] << 1) | (C[(x+1)%5] >> 63)) & _MASK) for x in range(5)]
+        B = [0]*25
+        for i in range(25):
+            a, r = state[i] ^ D[i%5], _ROT[i]
+            B[_PI[i]] = ((a << r) | (a >> (64 - r))) & _MASK
+        for i in range(25):
+            y = i - i%5
+            state[i] = B[i] ^ (~B[y + (i+1)%5] & B[y + (i+2)%5])
+        state[0] ^= rc
+
 class Keccak:
-    def __init__(self, rate, capacity, input_bytes, padding_byte):
-        if rate + capacity != 1600 or rate%8:
+    '''
+        Incremental sponge with hashlib-like interface: update(), digest(), hexdigest(), copy()
+        Input is absorbed one rate-sized block at a time, 8 bytes per lane
+    '''
+    __slots__ = ('name', 'digest_size', 'block_size', '_rate', '_padding_byte', '_state', '_buffer')
+
+    def __init__(self, rate, capacity, input_bytes=b'', padding_byte=0x06, digest_size=None, name=None):
+        '''
+            rate, capacity - in bits, rate + capacity == 1600
+            digest_size - output length in bytes, None for XOF (length passed to digest())
+        '''
+        if rate + capacity != 1600 or rate%64:
             raise ValueError
-        
-        # prepare constants
-        self._rho = [[0]*5 for _ in range(5)]
-        x, y = 1, 0
-        for t in range(1, 25):
-            self._rho[x][y] = t*(t+1)//2
-            x, y = y, (2*x + 3*y)%5
-
-        self._R = [0]*25
-        R = 1
-        for round in range(25):
-            for j in range(7):
-                R = ((R << 1) ^ ((R >> 7) * 0x71)) % 256
-                if R & 2:
-                    self._R[round] ^= (1 << ((1 << j) - 1))
 
+        self.name = name
+        self.digest_size = digest_size
+        self.block_size = rate // 8
         self._rate = rate // 8
-        self._state = [[0]*5 for _ in range(5)]
-        for i, byte in enumerate(input_bytes):
-            self._add_to_state(i % self._rate, byte)
-            if i+1 == self._rate: # block filled, need to hash
-                self._keccak_f()
-        self._add_to_state(len(input_bytes) % self._rate, padding_byte)
-        self._add_to_state(self._rate - 1, 0x80) # end of padding
-
-    def _add_to_state(self, pos, byte):
-        arr_pos = pos // 8
-        byte <<= 8 * (pos % 8) # shift to position on lane
-        self._state[arr_pos % 5][arr_pos // 5] ^= byte
-
-    @staticmethod
-    def _rot64(a, n):
-        n %= 64
-        return ((a >> (64 - n)) | (a << n)) & ((1 << 64) - 1)
-
-    def _keccak_f(self):
+        self._padding_byte = padding_byte
+        self._state = [0]*25
+        self._buffer = bytearray() # tail of input shorter than one block
+        if input_bytes:
+            self.update(input_bytes)
+
+    def _absorb(self, block, offset):
         state = self._state
-        R = 1
-        for round in range(24):
-            # θ
-            C = [state[x][0] ^ state[x][1] ^ state[x][2] ^ state[x][3] ^ state[x][4] for x in range(5)]
-            D = [C[(x + 4) % 5] ^ Keccak._rot64(C[(x + 1) % 5], 1) for x in range(5)]
-            state = [[state[x][y] ^ D[x] for y in range(5)] for x in range(5)]
-            # ρ and π
-            new_state = [[0]*5 for _ in range(5)]
-            for x in range(5):
-                for y in range(5):
-                    new_state[y][(2*x + 3*y)%5] = Keccak._rot64(state[x][y], self._rho[x][y])
-            state = new_state
-            # χ
-            for y in range(5):
-                T = [state[x][y] for x in range(5)]
-                for x in range(5):
-                    state[x][y] = T[x] ^ ((~T[(x + 1) % 5]) & T[(x + 2) % 5])
-            # ι
-            state[0][0] ^= self._R[round]
-        self._state = state
+        for lane in range(self._rate // 8):
+            pos = offset + 8*lane
+            state[lane] ^= int.from_bytes(block[pos:pos+8], 'little')
+        _keccak_f(state)
+
+    def update(self, data):
+        data = memoryview(data).cast('B')
+        rate, buffer = self._rate, self._buffer
+        pos = 0
+        if buffer:
+            pos = min(rate - len(buffer), len(data))
+            buffer += data[:pos]
+            if len(buffer) < rate:
+                return
+            self._absorb(buffer, 0)
+            buffer.clear()
+        while pos + rate <= len(data):
+            self._absorb(data, pos)
+            pos += rate
+        buffer += data[pos:]
+
+    def copy(self):
+        other = Keccak.__new__(Keccak)
+        other.name = self.name
+        other.digest_size = self.digest_size
+        other.block_size = self.block_size
+        other._rate = self._rate
+        other._padding_byte = self._padding_byte
+        other._state = self._state[:]
+        other._buffer = self._buffer[:]
+        return other
+
+    def digest(self, length=None):
+        '''
+            Return hash of data passed so far, object itself is not changed
+            length - required for XOF, ignored otherwise
+        '''
+        if self.digest_size is not None:
+            length = self.digest_size
+        elif length is None:
+            raise TypeError("digest length is required for XOF")
+
+        rate = self._rate
+        state = self._state[:]
+        block = self._buffer + bytes(rate - len(self._buffer))
+        block[len(self._buffer)] ^= self._padding_byte
+        block[rate - 1] ^= 0x80 # end of padding
+        for lane in range(rate // 8):
+            state[lane] ^= int.from_bytes(block[8*lane:8*lane+8], 'little')
 
-    def hash(self, byte_len):
         res = bytearray()
-        while byte_len > len(res):
-            self._keccak_f()
-            byte_state = b''.join(self._state[i%5][i//5].to_bytes(8, 'little') for i in range(25))
-            res += byte_state[:min(byte_len - len(res), self._rate)]
+        while length > len(res):
+            _keccak_f(state)
+            byte_state = b''.join(lane.to_bytes(8, 'little') for lane in state[:rate // 8])
+            res += byte_state[:length - len(res)]
         return bytes(res)
 
+    def hexdigest(self, length=None):
+        return self.digest(length).hex()
+
+    def hash(self, byte_len):
+        return self.digest(byte_len)
+
+_VARIANTS = {
+    # name: (rate, capacity, padding_byte, digest_size)
+    'sha3_224':  (1152,  448, 0x06, 224 // 8),
+    'sha3_256':  (1088,  512, 0x06, 256 // 8),
+    'sha3_384':  ( 832,  768, 0x06, 384 // 8),
+    'sha3_512':  ( 576, 1024, 0x06, 512 // 8),
+    'shake_128': (1344,  256, 0x1F, None),
+    'shake_256': (1088,  512, 0x1F, None),
+}
+
+def new(name, input_bytes=b''):
+    '''
+        Create streaming hasher, name is one of sha3_224, sha3_256, sha3_384, sha3_512, shake_128, shake_256
+    '''
+    if name not in _VARIANTS:
+        raise ValueError(f"unsupported hash type {name}")
+    rate, capacity, padding_byte, digest_size = _VARIANTS[name]
+    return Keccak(rate, capacity, input_bytes, padding_byte, digest_size, name)
+
+def file_digest(path, name='sha3_256', chunk_size=1 << 16):
+    '''
+        Hash file by chunks of chunk_size bytes, memory usage doesn't depend on file size
+        Return hasher object
+    '''
+    hasher = new(name)
+    chunk = bytearray(chunk_size)
+    view = memoryview(chunk)
+    with open(path, 'rb') as f:
+        while (read := f.readinto(chunk)):
+            hasher.update(view[:read])
+    return hasher
+
+def _keccak_f_many(lanes):
+    '''
+        Keccak-f[1600] over many independent states at once
+        lanes - list of 25 uint64 numpy arrays, lanes[i][k] is lane i of state k
+    '''
+    def rot(a, n):
+        return a if n == 0 else (a << n) | (a >> (64 - n))
+
+    B = [None]*25
+    for rc in _RC:
+        # θ
+        C = [lanes[x] ^ lanes[x+5] ^ lanes[x+10] ^ lanes[x+15] ^ lanes[x+20] for x in range(5)]
+        D = [C[(x+4)%5] ^ rot(C[(x+1)%5], 1) for x in range(5)]
+        # ρ and π
+        for i in range(25):
+            B[_PI[i]] = rot(lanes[i] ^ D[i%5], _ROT[i])
+        # χ
+        for i in range(25):
+            y = i - i%5
+            lanes[i] = B[i] ^ (~B[y + (i+1)%5] & B[y + (i+2)%5])
+        # ι
+        lanes[0] ^= rc
+
+def hash_many(name, messages):
+    '''
+        Hash list of independent messages in one batch, N states are kept in (N, 25) uint64 array
+        Messages of different length are padded to their own block count, shorter ones are masked out
+        of the later permutations. name is one of sha3_224, sha3_256, sha3_384, sha3_512
+        Return list of digests
+    '''
+    import numpy as np
+
+    rate_bits, _, padding_byte, digest_size = _VARIANTS[name]
+    if digest_size is None:
+        raise ValueError(f"{name} is XOF, batched hashing supports fixed digest size only")
+    if not messages:
+        return []
+    rate = rate_bits // 8
+
+    count = len(messages)
+    blocks = np.array([len(m) // rate + 1 for m in messages])
+    padded = np.zeros((count, int(blocks.max()) * rate), dtype=np.uint8)
+    for k, m in enumerate(messages):
+        padded[k, :len(m)] = np.frombuffer(m, dtype=np.uint8)
+        padded[k, len(m)] ^= padding_byte
+        padded[k, blocks[k]*rate - 1] ^= 0x80 # end of padding
+    padded = padded.view('<u8').reshape(count, -1, rate // 8)
+
+    state = np.zeros((count, 25), dtype=np.uint64)
+    for block in range(padded.shape[1]):
+        active = blocks > block
+        if active.all():
+            state[:, :rate // 8] ^= padded[:, block]
+            lanes = list(state.T.copy())
+            _keccak_f_many(lanes)
+            state = np.stack(lanes, axis=1)
+        else:
+            sub = state[active]
+            sub[:, :rate // 8] ^= padded[active, block]
+            lanes = list(sub.T.copy())
+            _keccak_f_many(lanes)
+            state[active] = np.stack(lanes, axis=1)
+
+    # digest is shorter than rate, so one squeeze is enough
+    out = state.astype('<u8').tobytes()
+    return [out[200*k : 200*k + digest_size] for k in range(count)]
+
+@timed("sha3_256_many", size=lambda args: sum(len(m) for m in args[0]))
+def sha3_256_many(messages):
+    return hash_many('sha3_256', messages)
+
+@timed("shake_128", size=0)
 def shake_128(input_bytes, output_byte_len):
-    return Keccak(1344, 256, input_bytes, 0x1F).hash(output_byte_len)
+    return new('shake_128', input_bytes).digest(output_byte_len)
 
+@timed("shake_256", size=0)
 def shake_256(input_bytes, output_byte_len):
-    return Keccak(1088, 512, input_bytes, 0x1F).hash(output_byte_len)
+    return new('shake_256', input_bytes).digest(output_byte_len)
 
+@timed("sha3_224", size=0)
 def sha3_224(input_bytes):
-    return Keccak(1152, 448, input_bytes, 0x06).hash(224 // 8)
+    return new('sha3_224', input_bytes).digest()
 
+@timed("sha3_256", size=0)
 def sha3_256(input_bytes):
-    return Keccak(1088, 512, input_bytes, 0x06).hash(256 // 8)
+    return new('sha3_256', input_bytes).digest()
 
+@timed("sha3_384", size=0)
 def sha3_384(input_bytes):
-    return Keccak( 832, 768, input_bytes, 0x06).hash(384 // 8)
+    return new('sha3_384', input_bytes).digest()
 
+@timed("sha3_512", size=0)
 def sha3_512(input_bytes):
-    return Keccak(576, 1024, input_bytes, 0x06).hash(512 // 8)
+    return new('sha3_512', input_bytes).digest()
 
 def tests():
-    import hashlib
-    names = ['sha3_224', 'sha3_256', 'sha3_384', 'sha3_512', 'shake_128', 'shake_256']
-    def test_str(s):
-        s = s.encode()
-        hashlib.sha3_224(b'')
+    import hashlib, random
+    def test_bytes(s):
         for func in ('sha3_224', 'sha3_256', 'sha3_384', 'sha3_512'):
-            our = eval(f"{func}(s)")
-            ans = eval(f"hashlib.{func}(s)").digest()
-            assert our == ans, f'{func}({s})'
+            our = globals()[func](s)
+            ans = getattr(hashlib, func)(s).digest()
+            assert our == ans, f'{func}({s[:32]})'
+        for func in ('shake_128', 'shake_256'):
+            for out_len in (1, 32, 200, 400):
+                our = globals()[func](s, out_len)
+                ans = getattr(hashlib, func)(s).digest(out_len)
+                assert our == ans, f'{func}({s[:32]}, {out_len})'
+
+    def test_str(s):
+        test_bytes(s.encode())
 
     test_str('')
     test_str('The quick brown fox jumps over the lazy dog')
     test_str('The quick brown fox jumps over the lazy dog.')
+    for n in (71, 72, 135, 136, 137, 167, 168, 169, 1000, 5000):
+        test_bytes(bytes(random.getrandbits(8) for _ in range(n)))
+
+    data = bytes(random.getrandbits(8) for _ in range(3000))
+    for func in ('sha3_224', 'sha3_256', 'sha3_384', 'sha3_512', 'shake_128', 'shake_256'):
+        hasher = new(func)
+        pos = 0
+        for step in (0, 1, 7, 64, 135, 136, 137, 500, 3000):
+            hasher.update(data[pos:pos+step])
+            pos += step
+        snapshot = hasher.copy()
+        hasher.update(b'tail')
+        ans = getattr(hashlib, func)(data)
+        if func.startswith('shake'):
+            assert snapshot.digest(64) == ans.digest(64), f'{func} streaming'
+        else:
+            assert snapshot.digest() == ans.digest(), f'{func} streaming'
+            ans.update(b'tail')
+            assert hasher.hexdigest() == ans.hexdigest(), f'{func} copy'
+
+    messages = [bytes(random.getrandbits(8) for _ in range(n)) for n in (0, 5, 135, 136, 137, 400, 1000)]
+    for func in ('sha3_224', 'sha3_256', 'sha3_384', 'sha3_512'):
+        ans = [getattr(hashlib, func)(m).digest() for m in messages]
+        assert hash_many(func, messages) == ans, f'{func} batched'
+
+    state = [random.getrandbits(64) for _ in range(25)]
+    reference = state[:]
+    _keccak_f(state)
+    _keccak_f_reference(reference)
+    assert state == reference, '_keccak_f'
     print("Tests passed successfully")
 
+def benchmark():
+    import hashlib, time
+    for size in (32, 1024, 64*1024, 1024*1024):
+        data = bytes(range(256)) * (size // 256) or bytes(size)
+        start = time.perf_counter()
+        h = sha3_256(data)
+        elapsed = time.perf_counter() - start
+        assert h == hashlib.sha3_256(data).digest()
+        print(f"sha3_256 {size:>8} B: {elapsed*1000:10.3f} ms, {size/elapsed/2**20:8.3f} MiB/s")
+
+    for size in (0, 32):
+        data = bytes(size)
+        count = 100000
+        start = time.perf_counter()
+        for _ in range(count // 100):
+            _gen_tables() # what every constructor used to pay
+            new('sha3_256', data)
+        per_call = (time.perf_counter() - start) / (count // 100)
+        start = time.perf_counter()
+        for _ in range(count):
+            new('sha3_256', data)
+        cached = (time.perf_counter() - start) / count
+        print(f"constructor {size:>2} B: tables per call {per_call*1e6:6.2f} us, cached {cached*1e6:6.2f} us")
+
+    messages = [bytes(range(64))] * 10000
+    start = time.perf_counter()
+    for m in messages[:1000]:
+        sha3_256(m)
+    single = (time.perf_counter() - start) / 1000
+    print(f"sha3_256 one by one, 64 B: {single*1e6:10.2f} us/message")
+    for batch in (1, 10, 100, 1000, 10000):
+        start = time.perf_counter()
+        sha3_256_many(messages[:batch])
+        elapsed = (time.perf_counter() - start) / batch
+        print(f"sha3_256_many batch {batch:>5}, 64 B: {elapsed*1e6:10.2f} us/message")
+
 def keccak_main():
     from_file = input("Choose file: ")
-    with open(from_file, 'rb') as ff:
-        fff = ff.read()
-    return sha3_256(fff)
+    return file_digest(from_file).digest()
 
 if __name__ == "__main__":
+    import sys
     tests()
+    if '--bench' in sys.argv:
+        benchmark()
+        sys.exit()
     from_file = input("Choose file: ")
-    with open(from_file, 'rb') as ff:
-        fff = ff.read()
-    h = sha3_256(fff)
-    print(f"Hash value is {hex(int.from_bytes(h, 'big'))[2:]}")
+    print(f"Hash value is {file_digest(from_file).hexdigest()}")
 
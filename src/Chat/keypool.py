@@ -0,0 +1,203 @@
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
+
+from RSA import RSA
+
+
+class FileLock:
+    '''
+        Exclusive lock between processes, held on file path while in with block
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+
+
+class KeyPool:
+    '''
+        Ephemeral RSA keys (n, e, d, p, q), generated in background.
+        When less than low keys are ready, background thread generates new ones until there are high keys.
+        cache_path - optional file, ready keys are kept in it and read back by a restarted client.
+                     Keys are taken from the file under lock file cache_path + ".lock", so clients
+                     sharing it never use the same key twice
+        processes - if > 0, keys are generated on process pool and don't take GIL from the caller
+    '''
+    def __init__(self, key_len: int, low: int = 2, high: int = 8, cache_path: str = None, processes: int = 0):
+        if not 0 <= low <= high or high == 0:
+            raise ValueError("watermarks must be 0 <= low <= high, high > 0")
+        self.key_len = key_len
+        self.low = low
+        self.high = high
+        self.cache_path = cache_path
+        self.lock_file = FileLock(cache_path + ".lock") if cache_path is not None else None
+        self.keys = self._load() # copy of the file, when it is used
+        self.generated = 0 # statistics: keys made in background
+        self.misses = 0    # get() calls that found pool empty
+        self.executor = ProcessPoolExecutor(processes) if processes > 0 else None
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _generate(self):
+        if self.executor is not None:
+            return self.executor.submit(RSA.generate_key, self.key_len, True).result()
+        return RSA.generate_key(self.key_len, with_primes=True)
+
+    def _fill(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.keys) >= self.low:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            while len(self.keys) < self.high and not self.closed:
+                key = self._generate()
+                self._update(lambda keys: keys.append(key))
+                self.generated += 1
+
+    def _update(self, change):
+        '''
+            Apply change to list of keys, in the cache file if it is used, return its result
+        '''
+        with self.cond:
+            if self.lock_file is None:
+                res = change(self.keys)
+            else:
+                with self.lock_file: # other clients may share the file
+                    keys = self._load()
+                    res = change(keys)
+                    self._save(keys)
+                self.keys = keys
+            self.cond.notify_all()
+            return res
+
+    def get(self):
+        '''
+            Return ready key (n, e, d, p, q). If pool is empty key is generated in place
+        '''
+        key = self._update(lambda keys: keys.pop() if keys else None)
+        if key is None:
+            self.misses += 1
+            return RSA.generate_key(self.key_len, with_primes=True)
+        return key
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _load(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return []
+        keys = []
+        with open(self.cache_path, "r") as f:
+            for line in f:
+                try:
+                    fields = tuple(map(int, line.split(", ")))
+                except ValueError: # damaged line
+                    continue
+                # keys of other length are skipped, generate_key gives n of exactly key_len bits
+                if len(fields) == 5 and fields[0].bit_length() == self.key_len:
+                    keys.append(fields)
+        return keys
+
+    def _save(self, keys):
+        lines = "".join(", ".join(map(str, key)) + "\n" for key in keys)
+        # private keys, readable by owner only; replace is atomic, so reader never sees half of file
+        tmp_path = self.cache_path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(lines)
+        os.replace(tmp_path, self.cache_path)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def benchmark(key_len: int = 512, count: int = 20):
+    '''
+        Time to get key for handshake: inline generation against ready pool
+    '''
+    import time
+    start = time.perf_counter()
+    for _ in range(count):
+        RSA.generate_key(key_len, with_primes=True)
+    inline = (time.perf_counter() - start) / count
+
+    pool = KeyPool(key_len, low=count, high=count)
+    while len(pool) < count:
+        time.sleep(0.01)
+    start = time.perf_counter()
+    for _ in range(count):
+        pool.get()
+    pooled = (time.perf_counter() - start) / count
+    pool.close()
+    print(f"RSA-{key_len} key: inline {inline*1000:.2f} ms, from pool {pooled*1000:.4f} ms")
+
+
+def tests():
+    import tempfile, time
+    path = os.path.join(tempfile.mkdtemp(), "keys.cache")
+    pool = KeyPool(64, low=2, high=4, cache_path=path)
+    while len(pool) < 4:
+        time.sleep(0.01)
+    n, e, d, p, q = pool.get()
+    rsa = RSA(n, e=e, d=d, p=p, q=q)
+    assert rsa.decrypt(rsa.encrypt(b"key", packed=True), packed=True) == b"key"
+    pool.close()
+
+    # restarted client takes cached keys, the taken one is not among them
+    restarted = KeyPool(64, low=0, high=4, cache_path=path)
+    assert len(restarted) >= 3 and (n, e, d, p, q) not in restarted.keys
+    for _ in range(len(restarted) + 1): # the last one is generated in place
+        restarted.get()
+    assert restarted.misses == 1
+    restarted.close()
+
+    # damaged lines and shorter keys are skipped; clients sharing the file never get the same key
+    with open(path, "a") as f:
+        f.write("12345, 6\n1, 2, x\n" + ", ".join(map(str, RSA.generate_key(32, with_primes=True))) + "\n")
+    first = KeyPool(64, low=3, high=6, cache_path=path)
+    while len(first) < 6:
+        time.sleep(0.01)
+    second = KeyPool(64, low=0, high=6, cache_path=path) # starts with the same 6 keys
+    assert all(key[0].bit_length() == 64 for key in second.keys)
+    taken = [pool.get() for _ in range(3) for pool in (first, second)]
+    assert len(set(taken)) == len(taken) and first.misses == second.misses == 0
+    first.close()
+    second.close()
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()
@@ -0,0 +1 @@
+g++ -O2 -o libAES_lib.so -shared -fPIC AES_lib.cpp
\ No newline at end of file
@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import io
+import json
+import socket
+import threading
+import time
+
+import qkd_store
+import session
+from AES_lib import gen_key
+from client import Client, FrameReader
+
+MARK = "#load" # marks generated messages among join/leave notices
+
+
+def percentiles(values, points=(0.5, 0.99, 0.999)):
+    '''
+        {"p50": ..., "p99": ..., "p999": ...} of values, None if there are none
+    '''
+    values = sorted(values)
+    res = {}
+    for q in points:
+        name = "p" + f"{q*100:g}".replace(".", "")
+        res[name] = values[min(len(values) - 1, int(q * len(values)))] if values else None
+    return res
+
+
+class SimClient:
+    '''
+        One simulated chat client: key exchange, messages at fixed rate, receiving side
+        measures latency (or only drains socket, if measure is False)
+    '''
+    def __init__(self, index: int, args, measure: bool):
+        self.index = index
+        self.args = args
+        self.measure = measure
+        self.client = None
+        self.handshake_time = None
+        self.error = None
+        self.store = session.TicketStore() if args.resume else None
+        self.link = None
+        self.sent = 0
+        self.latencies = [] # seconds, from scheduled send time to decryption by this client
+
+    def connect(self):
+        args = self.args
+        start = time.perf_counter()
+        try:
+            if args.quantum and self.link is None:
+                self.link = qkd_store.open_link((args.host, args.port))
+            sock = socket.create_connection((args.host, args.port))
+            reader = FrameReader(sock)
+            key = None
+            store = self.store
+            if store is not None:
+                key = session.client_resume(sock, reader, store)
+            if key is not None:
+                key = gen_key(key)
+            else:
+                if args.quantum:
+                    key = gen_key(qkd_store.client_key(sock, reader, self.link))
+                else:
+                    key = Client.get_key(sock, reader)
+                if store is not None:
+                    session.client_store(reader, key, store)
+            self.client = Client(key, sock, reader, keys=self.link and self.link.take)
+            self.client.send(f"load{self.index}")
+            self.handshake_time = time.perf_counter() - start
+        except OSError as err:
+            self.error = repr(err)
+
+    def send_loop(self, start: float, stop: float):
+        interval = 1 / self.args.rate
+        # clients start at different offsets, so messages are not sent in bursts
+        scheduled = start + interval * self.index / self.args.clients
+        padding = "x" * self.args.size
+        while scheduled < stop:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            # scheduled time, not actual: delay of a late sender is a part of latency too
+            try:
+                self.client.send(f"{MARK} {scheduled!r} {padding}")
+            except OSError:
+                return
+            self.sent += 1
+            scheduled += interval
+
+    def recv_loop(self):
+        sock = self.client.sock
+        try:
+            if not self.measure:
+                while sock.recv(1 << 16):
+                    pass
+                return
+            while True:
+                text = self.client.recv()
+                position = text.find(MARK)
+                if position >= 0:
+                    scheduled = float(text[position:].split(" ", 2)[1])
+                    self.latencies.append(time.perf_counter() - scheduled)
+        except (OSError, ValueError, UnicodeDecodeError):
+            pass
+
+
+def run(args):
+    clients = [SimClient(i, args, i < args.measure) for i in range(args.clients)]
+
+    def handshakes():
+        threads = [threading.Thread(target=c.connect) for c in clients]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()): # BB84 prints keys, output is JSON only
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return time.perf_counter() - start
+
+    handshake_wall = handshakes()
+    if args.resume: # the first connect gets tickets, measure reconnect
+        for c in clients:
+            if c.client is not None:
+                c.client.close()
+                c.client = None
+        handshake_wall = handshakes()
+    connected = [c for c in clients if c.client is not None]
+
+    receivers = [threading.Thread(target=c.recv_loop, daemon=True) for c in connected]
+    for thread in receivers:
+        thread.start()
+    time.sleep(args.settle) # join notices
+    start = time.perf_counter()
+    stop = start + args.duration
+    senders = [threading.Thread(target=c.send_loop, args=(start, stop)) for c in connected]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    send_wall = time.perf_counter() - start
+    time.sleep(args.settle) # messages in flight
+    for c in connected:
+        c.client.close()
+        if c.link is not None:
+            c.link.close()
+
+    handshake_times = [c.handshake_time for c in connected]
+    latencies = [x for c in connected for x in c.latencies]
+    sent = sum(c.sent for c in connected)
+    return {
+        "server": f"{args.host}:{args.port}",
+        "key_exchange": ("resume " if args.resume else "") + ("bb84" if args.quantum else "rsa"),
+        "clients": args.clients,
+        "connected": len(connected),
+        "errors": sorted({c.error for c in clients if c.error}),
+        "handshakes_per_sec": len(connected) / handshake_wall,
+        "handshake_ms": {k: v and v * 1000 for k, v in percentiles(handshake_times).items()},
+        "messages_sent": sent,
+        "messages_per_sec": sent / send_wall,
+        # every message is delivered to all other clients, only measuring ones decrypt and time it
+        "deliveries_expected": sum(sent - c.sent for c in connected if c.measure),
+        "deliveries_measured": len(latencies),
+        "latency_ms": {k: v and v * 1000 for k, v in {**percentiles(latencies),
+                                                      "max": max(latencies, default=None)}.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat server, prints JSON report")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=55555)
+    parser.add_argument("-c", "--clients", type=int, default=20, help="simulated clients")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second of every client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--size", type=int, default=64, help="bytes of padding in every message")
+    parser.add_argument("--measure", type=int, default=4,
+                        help="clients that decrypt messages and measure latency, the others only drain socket")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait before and after sending")
+    parser.add_argument("-q", "--quantum", action="store_true", help="BB84 key exchange, for server started with -q")
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help="connect twice, report handshakes of session resume, for server started with -r")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+'''
+    Opt-in instrumentation of hot paths: time histograms, call and byte counters.
+    Environment variables:
+        CHAT_METRICS=1               - enable, otherwise timed() returns functions unchanged
+        CHAT_METRICS_INTERVAL=10     - print snapshot to stderr every 10 seconds
+        CHAT_METRICS_FORMAT=json     - snapshot format for periodic print, text by default
+        CHAT_METRICS_HTTP=9100       - serve snapshot on http://127.0.0.1:9100/ (JSON, /text - text)
+'''
+
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+from functools import wraps
+
+ENABLED = os.environ.get('CHAT_METRICS', '') not in ('', '0')
+BUCKETS = 32 # bucket i counts calls of [2^(i-1), 2^i) microseconds, bucket 0 - below 1 us
+
+
+class Stat:
+    '''
+        Calls, total and max time, bytes and log2 histogram of one stage
+    '''
+    __slots__ = ('lock', 'count', 'total_ns', 'max_ns', 'bytes', 'buckets')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.bytes = 0
+        self.buckets = [0] * BUCKETS
+
+    def record(self, ns: int, nbytes: int = 0):
+        i = min((ns // 1000).bit_length(), BUCKETS - 1)
+        with self.lock:
+            self.count += 1
+            self.total_ns += ns
+            self.bytes += nbytes
+            self.buckets[i] += 1
+            if ns > self.max_ns:
+                self.max_ns = ns
+
+    def add(self, nbytes: int):
+        with self.lock:
+            self.count += 1
+            self.bytes += nbytes
+
+    def snapshot(self):
+        with self.lock:
+            res = {"count": self.count, "bytes": self.bytes}
+            if self.total_ns:
+                res["total_ms"] = self.total_ns / 1e6
+                res["mean_us"] = self.total_ns / self.count / 1e3
+                res["max_us"] = self.max_ns / 1e3
+                res["buckets_us"] = {f"<{1 << i}": n for i, n in enumerate(self.buckets) if n}
+            return res
+
+
+stats = {}   # stage name -> Stat
+sources = {} # name -> function returning dict, snapshots of other components
+_stats_lock = threading.Lock()
+
+def stat(name: str):
+    res = stats.get(name)
+    if res is None:
+        with _stats_lock:
+            res = stats.setdefault(name, Stat())
+    return res
+
+def _size(x):
+    try:
+        return memoryview(x).nbytes
+    except TypeError:
+        return len(x)
+
+def timed(name: str, size: int = None):
+    '''
+        Decorator, times every call of function as stage name.
+        size - index of positional argument whose length is added to byte counter (the argument may be
+               passed by keyword too), or function of positional arguments returning number of bytes
+        When disabled function is returned as it is, without any overhead
+    '''
+    def decorator(func):
+        if not ENABLED:
+            return func
+        s = stat(name)
+        if size is None or callable(size):
+            keyword = None
+        else:
+            params = list(inspect.signature(func).parameters)
+            keyword = params[size] if size < len(params) else None
+        def nbytes(args, kwargs):
+            # counting must not replace result or exception of the call
+            try:
+                if size is None:
+                    return 0
+                if callable(size):
+                    return size(args)
+                return _size(args[size] if size < len(args) else kwargs[keyword])
+            except Exception:
+                return 0
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                s.record(time.perf_counter_ns() - start, nbytes(args, kwargs))
+        return wrapper
+    return decorator
+
+def instrument(cls, prefix: str, methods, size: int = 1):
+    '''
+        Subclass of cls with timed methods, cls itself when disabled.
+        A timed method called by another one (encrypt by encrypt_into) is counted with the outer call only
+    '''
+    if not ENABLED:
+        return cls
+    local = threading.local()
+    def outer_only(func, timed_func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(local, "busy", False):
+                return func(*args, **kwargs)
+            local.busy = True
+            try:
+                return timed_func(*args, **kwargs)
+            finally:
+                local.busy = False
+        return wrapper
+    methods = {m: getattr(cls, m) for m in methods}
+    return type(cls.__name__, (cls,), {m: outer_only(func, timed(f"{prefix}.{m}", size)(func))
+                                       for m, func in methods.items()})
+
+class _Timer:
+    __slots__ = ('stat', 'start')
+
+    def __init__(self, s):
+        self.stat = s
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        self.stat.record(time.perf_counter_ns() - self.start)
+
+class _NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name: str):
+    '''
+        with timer("stage"): ... - time block of code
+    '''
+    return _Timer(stat(name)) if ENABLED else _null_timer
+
+def add(name: str, nbytes: int = 0):
+    '''
+        Count event of stage name with nbytes bytes, without timing
+    '''
+    if ENABLED:
+        stat(name).add(nbytes)
+
+def register(name: str, snapshot):
+    '''
+        Add snapshot() of other component (for example FanOutMetrics) to exported snapshot
+    '''
+    if ENABLED:
+        sources[name] = snapshot
+
+
+def snapshot():
+    res = {"time": time.time(), "stages": {name: s.snapshot() for name, s in sorted(stats.items()) if s.count}}
+    for name, source in sources.items():
+        res[name] = source()
+    return res
+
+def format_text(snap=None):
+    snap = snap or snapshot()
+    lines = [f"{'stage':<28}{'count':>10}{'mean us':>12}{'max us':>12}{'total ms':>12}{'bytes':>14}"]
+    for name, s in snap["stages"].items():
+        lines.append(f"{name:<28}{s['count']:>10}{s.get('mean_us', 0):>12.1f}{s.get('max_us', 0):>12.1f}"
+                     f"{s.get('total_ms', 0):>12.1f}{s['bytes']:>14}")
+    for name, value in snap.items():
+        if name not in ("time", "stages"):
+            lines.append(f"{name}: {json.dumps(value)}")
+    return "\n".join(lines)
+
+
+def _report_loop(interval: float, as_json: bool):
+    while True:
+        time.sleep(interval)
+        print(json.dumps(snapshot()) if as_json else format_text(), file=sys.stderr, flush=True)
+
+def _serve_http(port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/text"):
+                body, kind = format_text().encode(), "text/plain"
+            else:
+                body, kind = json.dumps(snapshot()).encode(), "application/json"
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if ENABLED:
+    if os.environ.get('CHAT_METRICS_INTERVAL'):
+        threading.Thread(target=_report_loop, daemon=True,
+                         args=(float(os.environ['CHAT_METRICS_INTERVAL']),
+                               os.environ.get('CHAT_METRICS_FORMAT') == 'json')).start()
+    if os.environ.get('CHAT_METRICS_HTTP'):
+        _serve_http(int(os.environ['CHAT_METRICS_HTTP']))
@@ -0,0 +1,440 @@
+'''
+    Key store of quantum key distribution, opt-in (-q flag of ser.py and cl.py).
+    Client opens key link, separate connection to port of the chat + LINK_PORT_OFFSET, and sends its
+    random peer id. On the link server runs BB84 sessions (Q_Key_Exchange, server is Alice) in background
+    whenever less than low key blocks of the peer are ready, until there are high ones.
+    Every session gives SESSION_BLOCKS blocks of AES_KEY_LEN bytes, numbered in the same order on both sides,
+    so a key is named by its number and is never sent.
+
+    Key exchange of chat connection:
+        client hello: peer id                    - b"" without key link
+        server answer: number of key block       - b"" if there is no ready block, then BB84 runs
+                                                   on the chat connection as before
+    In-session rekeying: every REKEY_INTERVAL seconds server takes next block of the peer, see Client.rekey
+'''
+
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
+import metrics
+from AES_lib import AES_KEY_LEN
+from client import Q_Key_Exchange, FrameReader, FRAME_HEADER, send_frame
+
+LINK_PORT_OFFSET = 1
+PEER_ID_LEN = 16
+SESSION_BLOCKS = 4     # key blocks distilled by one BB84 session
+LOW_BLOCKS = 2         # ready blocks of a peer, below which new sessions are started
+HIGH_BLOCKS = 8
+TAKE_TIMEOUT = 10      # seconds to wait for a block for a new chat connection
+REKEY_INTERVAL = 60    # seconds between rekeyings of a connection
+LINK_POLL = 1          # seconds between checks that idle key link is not closed
+
+BLOCK_NUMBER = struct.Struct(">Q")
+
+
+def link_address(address):
+    host, port = address
+    return host, port + LINK_PORT_OFFSET
+
+
+class PeerKeys:
+    '''
+        Numbered key blocks shared with one peer, safe for use from many threads
+    '''
+    def __init__(self, peer: bytes, low: int = LOW_BLOCKS, high: int = HIGH_BLOCKS):
+        if not 0 <= low <= high or high == 0:
+            raise ValueError("watermarks must be 0 <= low <= high, high > 0")
+        self.peer = peer
+        self.low = low
+        self.high = high
+        self.blocks = OrderedDict() # number -> key
+        self.next_number = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.sessions = 0 # statistics: BB84 sessions, blocks given out, takes that found no block
+        self.taken = 0
+        self.misses = 0
+
+    def add(self, key: bytes):
+        '''
+            Split key of a session into blocks
+        '''
+        with self.cond:
+            for i in range(0, len(key) - AES_KEY_LEN + 1, AES_KEY_LEN):
+                self.blocks[self.next_number] = key[i:i+AES_KEY_LEN]
+                self.next_number += 1
+            self.sessions += 1
+            self.cond.notify_all()
+
+    def take(self, number: int = None, timeout: float = None):
+        '''
+            Remove block and return (number, key). number None - the oldest block (server side),
+            otherwise the block named by the other side is waited for.
+            None if it is not ready in timeout seconds or the link is closed
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if number is None and self.blocks:
+                    res = self.blocks.popitem(last=False)
+                    break
+                if number is not None and number in self.blocks:
+                    res = number, self.blocks.pop(number)
+                    break
+                if number is not None and number < self.next_number: # taken already
+                    raise KeyError(f"key block {number} is used")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if self.closed or (remaining is not None and remaining <= 0):
+                    self.misses += 1
+                    metrics.add("qkd.miss")
+                    return None
+                self.cond.wait(remaining)
+            self.taken += 1
+            if len(self.blocks) < self.low:
+                self.cond.notify_all()
+        metrics.add("qkd.take")
+        return res
+
+    def wait_low(self, timeout: float = None):
+        '''
+            Block until more keys are needed and return True.
+            False if the link is closed or nothing is needed in timeout seconds
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or len(self.blocks) < self.low, timeout)
+            return not self.closed and len(self.blocks) < self.low
+
+    def full(self):
+        return len(self.blocks) >= self.high
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def snapshot(self):
+        return {"blocks": len(self.blocks), "sessions": self.sessions, "taken": self.taken, "misses": self.misses}
+
+
+def _distil(sock, reader, keys: PeerKeys, alice: bool):
+    need_bytes = SESSION_BLOCKS * AES_KEY_LEN
+    with metrics.timer("qkd.session"):
+        q = Q_Key_Exchange(sock, need_bytes, reader, verbose=False)
+        keys.add(bytes(q.do_alice_part() if alice else q.do_bob_part()))
+
+
+class KeyStore:
+    '''
+        Server side: key links of all peers, each one served by its own thread
+    '''
+    def __init__(self, low: int = LOW_BLOCKS, high: int = HIGH_BLOCKS):
+        self.low = low
+        self.high = high
+        self.peers = {} # peer id -> PeerKeys
+        self.retired = set() # ids of closed links, never accepted again
+        self.lock = threading.Condition()
+        self.server = None
+
+    def serve(self, address):
+        '''
+            Accept key links on address in background
+        '''
+        self.server = socket.create_server(address)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.server.getsockname()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except OSError: # closed
+                return
+            threading.Thread(target=self._link, args=(sock,), daemon=True).start()
+
+    def _link(self, sock):
+        reader = FrameReader(sock)
+        keys = None
+        try:
+            peer = bytes(reader.read_frame())
+            if len(peer) != PEER_ID_LEN:
+                return
+            # the id is sent in clear in chat hello: a link with a known id must not take
+            # over the blocks of chat connections, so every id names one link only
+            with self.lock:
+                if peer in self.peers or peer in self.retired:
+                    metrics.add("qkd.duplicate")
+                    return
+                keys = PeerKeys(peer, self.low, self.high)
+                self.peers[peer] = keys
+                self.lock.notify_all()
+            while not keys.closed:
+                if keys.wait_low(LINK_POLL):
+                    while not keys.full():
+                        _distil(sock, reader, keys, alice=True)
+                elif select.select([sock], [], [], 0)[0]: # client sends nothing unasked, so it is closed
+                    break
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            sock.close()
+            if keys is not None:
+                keys.close()
+                with self.lock:
+                    del self.peers[keys.peer]
+                    self.retired.add(keys.peer)
+
+    def take(self, peer: bytes, timeout: float = None):
+        '''
+            (number, key) of the next block of peer, None if there is no such peer or ready block.
+            Key link of a new client may be accepted after its chat connection, so peer is waited for too
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            self.lock.wait_for(lambda: peer in self.peers, timeout)
+            keys = self.peers.get(peer)
+        if keys is None:
+            return None
+        return keys.take(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def next_key(self, client):
+        '''
+            (number, key) for rekeying of client if it is due and a block is ready, otherwise None
+        '''
+        if client.peer is None or time.monotonic() - client.key_time < REKEY_INTERVAL:
+            return None
+        return self.take(client.peer, timeout=0)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        with self.lock:
+            peers = list(self.peers.values())
+        for keys in peers:
+            keys.close()
+
+    def snapshot(self):
+        with self.lock:
+            peers = list(self.peers.values())
+        return {"peers": len(peers),
+                "blocks": sum(len(keys) for keys in peers),
+                "sessions": sum(keys.sessions for keys in peers),
+                "taken": sum(keys.taken for keys in peers),
+                "misses": sum(keys.misses for keys in peers),
+                "fill": {keys.peer.hex()[:8]: len(keys) for keys in peers}}
+
+
+class KeyLink:
+    '''
+        Client side: key link to the server, BB84 sessions are answered in background
+    '''
+    def __init__(self, address):
+        self.peer = os.urandom(PEER_ID_LEN)
+        self.keys = PeerKeys(self.peer)
+        self.sock = socket.create_connection(address)
+        send_frame(self.sock, self.peer)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        reader = FrameReader(self.sock)
+        try:
+            while True:
+                _distil(self.sock, reader, self.keys, alice=False)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.keys.close()
+
+    def take(self, number: int, timeout: float = TAKE_TIMEOUT):
+        '''
+            Key of block named by the server, ConnectionError if it is used or not distilled
+        '''
+        try:
+            block = self.keys.take(number, timeout)
+        except KeyError as err: # named twice
+            raise ConnectionError(str(err))
+        if block is None:
+            raise ConnectionError(f"key block {number} is not distilled")
+        return block[1]
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR) # wakes background thread blocked in recv
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def open_link(address):
+    '''
+        Key link to the chat server at address, None if the server has no key links
+        (sharded server, ser.py -w): then BB84 runs on every chat connection
+    '''
+    try:
+        return KeyLink(link_address(address))
+    except ConnectionRefusedError:
+        return None
+
+def server_key(sock, reader, store: KeyStore):
+    '''
+        Key exchange of chat connection, server side. Return (key, peer id),
+        peer id is None if key was made by BB84 on the connection itself
+    '''
+    peer = bytes(reader.read_frame())
+    block = store.take(peer, TAKE_TIMEOUT) if store is not None and peer else None
+    if block is None:
+        send_frame(sock, b"")
+        return Q_Key_Exchange(sock, reader=reader).do_alice_part(), None
+    send_frame(sock, BLOCK_NUMBER.pack(block[0]))
+    return block[1], peer
+
+def client_key(sock, reader, link: KeyLink = None):
+    '''
+        Key exchange of chat connection, client side
+    '''
+    send_frame(sock, link.peer if link is not None else b"")
+    answer = bytes(reader.read_frame())
+    if not answer:
+        return Q_Key_Exchange(sock, reader=reader).do_bob_part()
+    return link.take(BLOCK_NUMBER.unpack(answer)[0])
+
+
+def benchmark(count: int = 20):
+    '''
+        Time of key exchange of chat connection: BB84 on the connection against a block from the store
+    '''
+    import contextlib, io
+    store = KeyStore(high=count + LOW_BLOCKS)
+    address = store.serve(("127.0.0.1", 0))
+    for name in ("inline", "store"):
+        link = KeyLink(address) if name == "store" else None
+        if link is not None:
+            while len(store.peers.get(link.peer, ())) < count: # filled in background
+                time.sleep(0.01)
+        total = 0
+        for _ in range(count):
+            a, b = socket.socketpair()
+            res = {}
+            thread = threading.Thread(target=lambda: res.update(key=server_key(a, FrameReader(a), store)[0]))
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()): # BB84 prints keys
+                thread.start()
+                key = client_key(b, FrameReader(b), link)
+                thread.join()
+            total += time.perf_counter() - start
+            assert bytes(key) == bytes(res["key"])
+            a.close()
+            b.close()
+        print(f"{name:>6}: {total/count*1000:8.3f} ms per key exchange")
+        if link is not None:
+            print(f"store: {store.snapshot()}")
+            link.close()
+    store.close()
+
+
+def tests():
+    import contextlib, io
+    from AES_lib import gen_key
+    from client import Client
+    store = KeyStore(low=2, high=4)
+    address = store.serve(("127.0.0.1", 0))
+    link = KeyLink(address)
+
+    def connect(link):
+        a, b = socket.socketpair()
+        res = {}
+        def server():
+            reader = FrameReader(a)
+            key, peer = server_key(a, reader, store)
+            res["client"] = Client(gen_key(key), a, reader)
+            res["client"].peer = peer
+        thread = threading.Thread(target=server)
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread.start()
+            reader = FrameReader(b)
+            key = client_key(b, reader, link)
+            thread.join()
+        return res["client"], Client(gen_key(key), b, reader, keys=link and link.take)
+
+    server, client = connect(link)
+    assert server.peer == link.peer and bytes(server.key) == bytes(client.key)
+    client.send("hello")
+    assert server.recv() == "hello"
+    # one session gave 4 blocks, one of them is used by connection
+    assert len(store.peers[link.peer]) == len(link.keys) == 3
+    # below low watermark the pool is refilled in background
+    store.take(link.peer)
+    store.take(link.peer)
+    deadline = time.monotonic() + 10
+    while len(link.keys) < 7 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(store.peers[link.peer]) == 5 and len(link.keys) == 7
+    # rekeying: frames sent before it are decrypted with the old key, after it - with the new one
+    global REKEY_INTERVAL
+    interval, REKEY_INTERVAL = REKEY_INTERVAL, 0
+    server.send("old key")
+    number, key = store.next_key(server)
+    server.rekey(number, key)
+    server.send("new key")
+    client.send("old key")
+    assert client.recv() == "old key" and client.recv() == "new key"
+    assert bytes(client.key) == bytes(key) and number not in link.keys.blocks
+    client.send("new key")
+    assert server.recv() == "old key" and server.recv() == "new key"
+    assert server.rekey_number is None and server.recv_aes is server.aes
+    REKEY_INTERVAL = interval
+    assert store.next_key(server) is None # not due yet
+    # a second link with the same id is refused, blocks of the first one stay
+    sock = socket.create_connection(address)
+    send_frame(sock, link.peer)
+    assert sock.recv(1) == b"" and not store.peers[link.peer].closed
+    sock.close()
+    # rekeying frames which can't be applied: changed, with used block, to a client without key link
+    frame = bytearray(server.rekey_frame(number, key)[FRAME_HEADER.size:])
+    frame[-1] ^= 1
+    bad = [bytes(frame), server.rekey_frame(number, key)[FRAME_HEADER.size:]]
+    for frame in bad:
+        try:
+            client.open(frame)
+            assert False
+        except ConnectionError:
+            pass
+    try:
+        Client(client.key, None).open(bad[1])
+        assert False
+    except ConnectionError:
+        pass
+    # without key link BB84 runs on the connection
+    free = socket.create_server(("127.0.0.1", 0))
+    free_address = free.getsockname()
+    free.close()
+    assert open_link((free_address[0], free_address[1] - LINK_PORT_OFFSET)) is None
+    server, client = connect(None)
+    assert server.peer is None and bytes(server.key) == bytes(client.key)
+    link.close()
+    deadline = time.monotonic() + 10
+    while link.peer in store.peers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.snapshot()["peers"] == 0
+    # nor after the first one is closed: chat connections of it are not rekeyed to keys of the new one
+    sock = socket.create_connection(address)
+    send_frame(sock, link.peer)
+    assert sock.recv(1) == b"" and link.peer not in store.peers
+    sock.close()
+    store.close()
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()
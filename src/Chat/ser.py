@@ -4,15 +4,30 @@ import sys
 import time
 
 from AES_lib import gen_key
-from client import Client, Q_Key_Exchange
+import metrics
+import qkd_store
+import session
+from client import Client, FrameReader
+from fanout import FanOut
 
 server_sock = ['0.0.0.0', 55555]
 
+# -w K: K worker processes sharing the port, see ser_sharded.py
+if '-w' in sys.argv:
+    import ser_sharded
+    ser_sharded.main(int(sys.argv[sys.argv.index('-w') + 1]), tuple(server_sock))
+    sys.exit()
+
 # if len(sys.argv) > 2:
 #     server_sock[1] = sys.argv[1]
 # if len(sys.argv) > 2:
 #     server_sock[2] = int(sys.argv[2])
 
+# Encrypts and sends broadcast messages. Created before any thread is started,
+# and before the listening socket, which process pool workers would inherit
+fanout = FanOut()
+metrics.register("fanout", fanout.metrics.snapshot)
+
 # Starting Server
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server.bind(tuple(server_sock))
@@ -23,11 +38,35 @@ stop = False
 # Lists For Clients and 
 clients = []
 
+# -r: session tickets, returning clients skip key exchange
+tickets = session.TicketCache() if '-r' in sys.argv else None
+
+# -q: keys are distilled by BB84 on key links of clients in background, see qkd_store.py
+key_store = None
+if '-q' in sys.argv:
+    key_store = qkd_store.KeyStore()
+    key_store.serve(qkd_store.link_address(tuple(server_sock)))
+    metrics.register("qkd", key_store.snapshot)
+
+# Messages are encrypted outside of send locks of clients, so rekeying
+# must not happen while another broadcast is in progress
+broadcast_lock = threading.Lock()
+
 # Sending Messages To All Connected Clients
+@metrics.timed("server.broadcast")
 def broadcast(message, sender):
-    for client in clients:
-        if client != sender:
-            client.send(message)
+    recipients = [client for client in clients if client != sender]
+    with broadcast_lock:
+        if key_store is not None:
+            for client in list(recipients):
+                block = key_store.next_key(client)
+                if block is None:
+                    continue
+                try:
+                    client.rekey(*block)
+                except OSError: # like a failed delivery of FanOut, handle() of the client removes it
+                    recipients.remove(client)
+        fanout.broadcast(message, recipients)
 
 # Handling Messages From encrypt
 def handle(client: Client):
@@ -46,6 +85,37 @@ def handle(client: Client):
             break
 
 
+# Create client with new key, or with resumed one
+@metrics.timed("server.handshake")
+def handshake(sock):
+    reader = FrameReader(sock)
+    key = session.server_resume(sock, reader, tickets) if tickets is not None else None
+    if key is not None: # returning client, no key exchange
+        return Client(gen_key(key), sock, reader)
+    if '-q' in sys.argv:
+        key, peer = qkd_store.server_key(sock, reader, key_store)
+        client = Client(gen_key(key), sock, reader)
+        client.peer = peer
+    else:
+        client = Client(gen_key(key), sock, reader)
+        client.key_exchange()
+    if tickets is not None:
+        session.server_issue(sock, client.key, tickets)
+    return client
+
+
+# Key exchange and messages of one client, so a slow key exchange doesn't block accepting others
+def serve(sock, address):
+    try:
+        client = handshake(sock)
+    except (ConnectionError, OSError, ValueError) as err:
+        print(f"Handshake with {address} failed: {err!r}")
+        sock.close()
+        return
+    clients.append(client)
+    handle(client)
+
+
 # Receiving / Listening Function
 def receive():
     while not stop:
@@ -53,18 +123,8 @@ def receive():
         sock, address = server.accept()
         print(f"Connected with {address}")
 
-        # create client with new key
-        key = None
-        if '-q' in sys.argv:
-            key = Q_Key_Exchange(sock).do_alice_part()
-            client = Client(gen_key(key), sock)
-        else:
-            client = Client(gen_key(key), sock)
-            client.key_exchange()
-        clients.append(client)
-
         # Start Handling Thread For Client
-        thread = threading.Thread(target=handle, args=(client,))
+        thread = threading.Thread(target=serve, args=(sock, address))
         thread.start()
 
 receive_thread = threading.Thread(target=receive)
@@ -75,5 +135,6 @@ try:
         time.sleep(1)
 except KeyboardInterrupt:
     print("quitting")
+    print(fanout.metrics.snapshot())
     stop = True
     sys.exit()
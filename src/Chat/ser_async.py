@@ -0,0 +1,174 @@
+import asyncio
+import socket
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from AES_lib import gen_key
+import metrics
+import qkd_store
+import session
+from client import Client, FrameReader, FRAME_HEADER, MAX_FRAME_LEN
+
+server_sock = ['0.0.0.0', 55555]
+
+OUT_QUEUE_LEN = 256      # messages waiting for a slow client before it is dropped
+HANDSHAKE_TIMEOUT = 30   # seconds for RSA/BB84 key exchange
+HANDSHAKE_WORKERS = 8    # key exchanges running at once
+
+# Connected clients, touched only from the event loop thread
+peers = set()
+tasks = set() # keep references to connection tasks
+
+# -r: session tickets, returning clients skip key exchange. Each ser_sharded worker has its own
+tickets = session.TicketCache() if '-r' in sys.argv else None
+
+# Called with every message of local clients, ser_sharded sets it to pass messages to other workers
+relay = None
+
+# -q: key store of key links, standalone server only: ser_sharded workers run BB84 on chat connections
+key_store = None
+
+
+class Peer:
+    '''
+        Connected client: encryption state and queue of outgoing encrypted messages
+    '''
+    def __init__(self, client: Client, writer: asyncio.StreamWriter):
+        self.client = client
+        self.writer = writer
+        self.queue = asyncio.Queue(OUT_QUEUE_LEN)
+        self.closed = False
+
+    def put(self, text):
+        '''
+            Queue encrypted message, drop the client if it can't keep up
+        '''
+        if self.closed:
+            return
+        try:
+            block = key_store.next_key(self.client) if key_store is not None else None
+            if block is not None:
+                self.queue.put_nowait(self.client.rekey_frame(*block))
+            self.queue.put_nowait(self.client.encrypt_frame(text))
+        except asyncio.QueueFull:
+            print(f"Dropping slow client {self.client.nick}")
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                self.writer.write(await self.queue.get())
+                await self.writer.drain() # wait while socket buffer is full
+        except (ConnectionError, OSError):
+            self.close()
+
+
+# Sending Messages To All Connected Clients
+@metrics.timed("server.broadcast")
+def broadcast(message, sender):
+    '''
+        sender is None for messages that came from other workers
+    '''
+    for peer in list(peers):
+        if peer != sender:
+            peer.put(message)
+    if relay is not None and sender is not None:
+        relay(message)
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_LEN:
+        raise ConnectionError(f"frame of {length} bytes is too long")
+    return await reader.readexactly(length)
+
+
+@metrics.timed("server.handshake")
+def handshake(sock):
+    '''
+        Blocking key exchange, runs in handshake executor.
+        The exchange is lock-step, client sends nothing after its last message
+        before the server answers, so no data is left in handshake reader
+    '''
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    reader = FrameReader(sock)
+    key = session.server_resume(sock, reader, tickets) if tickets is not None else None
+    if key is not None:
+        return Client(gen_key(key), sock, reader)
+    if '-q' in sys.argv:
+        key, peer = qkd_store.server_key(sock, reader, key_store)
+        client = Client(gen_key(key), sock, reader)
+        client.peer = peer
+    else:
+        client = Client(gen_key(), sock, reader)
+        client.key_exchange()
+    if tickets is not None:
+        session.server_issue(sock, client.key, tickets)
+    return client
+
+
+async def serve(sock, address, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        client = await loop.run_in_executor(executor, handshake, sock)
+    except Exception as err:
+        print(f"Handshake with {address} failed: {err!r}")
+        sock.close()
+        return
+    client.reader = None # frames are read by the stream from now on, 64 KiB handshake buffer is freed
+    sock.setblocking(False)
+    reader, writer = await asyncio.open_connection(sock=sock)
+    peer = Peer(client, writer)
+    writer_task = asyncio.create_task(peer.write_loop())
+    try:
+        client.set_nickname(client.decrypt(await read_frame(reader)))
+        peers.add(peer)
+        broadcast(f"{client.nick} was joined!", peer)
+        while not peer.closed:
+            text = client.open(await read_frame(reader))
+            if text is not None: # not rekeying
+                broadcast(f"{client.nick}: {text}", peer)
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer_task.cancel()
+        peer.close()
+        if peer in peers:
+            peers.discard(peer)
+            broadcast(f'{client.nick} left!', peer)
+
+
+async def main(server=None):
+    '''
+        Accept clients on listening socket server, by default it is opened on server_sock
+    '''
+    global key_store
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(HANDSHAKE_WORKERS)
+    if server is None:
+        server = socket.create_server(tuple(server_sock), backlog=4096)
+        if '-q' in sys.argv:
+            key_store = qkd_store.KeyStore()
+            key_store.serve(qkd_store.link_address(tuple(server_sock)))
+            metrics.register("qkd", key_store.snapshot)
+    server.setblocking(False)
+    while True:
+        # Accept Connection
+        sock, address = await loop.sock_accept(server)
+        print(f"Connected with {address}")
+        task = asyncio.create_task(serve(sock, address, executor))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("quitting")
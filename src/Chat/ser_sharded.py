@@ -0,0 +1,155 @@
+import asyncio
+import os
+import signal
+import socket
+import sys
+
+import ser_async
+from client import FRAME_HEADER
+
+WORKERS = os.cpu_count() or 1
+
+
+class Bus:
+    '''
+        Links of one worker to all other workers, one Unix socketpair for every pair of workers.
+        Every message is a length-prefixed frame of utf-8 text, which receiving worker
+        encrypts for its own clients
+    '''
+    def __init__(self, socks):
+        self.socks = socks
+        self.writers = []
+
+    async def start(self):
+        for sock in self.socks:
+            sock.setblocking(False)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.writers.append(writer)
+            task = asyncio.create_task(self.read_loop(reader))
+            ser_async.tasks.add(task)
+            task.add_done_callback(ser_async.tasks.discard)
+
+    def publish(self, message):
+        sb = bytes(message, 'utf-8')
+        frame = FRAME_HEADER.pack(len(sb)) + sb
+        for writer in self.writers:
+            writer.write(frame)
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                ser_async.broadcast(str(await ser_async.read_frame(reader), 'utf-8'), None)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass # worker exited
+
+
+async def run_worker(links, address):
+    bus = Bus(links)
+    await bus.start()
+    ser_async.relay = bus.publish
+    # kernel spreads new connections among all sockets bound to the same port
+    server = socket.create_server(address, backlog=4096, reuse_port=True)
+    await ser_async.main(server)
+
+
+def main(workers: int = WORKERS, address=tuple(ser_async.server_sock)):
+    '''
+        Fork workers, each one accepts its own clients and keeps their keys.
+        Unix only: it needs fork and SO_REUSEPORT
+    '''
+    links = [[None] * workers for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            links[i][j], links[j][i] = socket.socketpair()
+
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            own = [sock for sock in links[i] if sock is not None]
+            for row in links:
+                for sock in row:
+                    if sock is not None and sock not in own:
+                        sock.close()
+            try:
+                asyncio.run(run_worker(own, address))
+            except KeyboardInterrupt:
+                pass
+            os._exit(0)
+        pids.append(pid)
+
+    for row in links:
+        for sock in row:
+            if sock is not None:
+                sock.close()
+    print(f"Started {workers} workers on port {address[1]}")
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        print("quitting")
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def benchmark(worker_counts=(1, 2, 4), clients=16, messages=8, port=55600):
+    '''
+        Start server with K workers, every client sends messages and all clients receive all of them.
+        Print delivered messages per second. (clients-1)*messages must stay below ser_async.OUT_QUEUE_LEN,
+        otherwise slow test clients are dropped
+    '''
+    import subprocess
+    import threading
+    import time
+    from client import Client, FrameReader
+
+    for workers in worker_counts:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '-w', str(workers), '-p', str(port)],
+                                  stdout=subprocess.DEVNULL)
+        time.sleep(1)
+        conns = []
+        for k in range(clients):
+            sock = socket.create_connection(('127.0.0.1', port))
+            reader = FrameReader(sock)
+            conns.append(Client(Client.get_key(sock, reader), sock, reader))
+            conns[-1].send(f"c{k}")
+        time.sleep(0.5)
+        expected = clients * (clients - 1) * messages
+        def read(client, count):
+            for _ in range(count):
+                client.recv()
+        # join notices are received first, client k sees clients-1-k of them
+        for k, client in enumerate(conns):
+            for _ in range(clients - 1 - k):
+                client.recv()
+        start = time.perf_counter()
+        readers = [threading.Thread(target=read, args=(client, (clients - 1) * messages)) for client in conns]
+        for reader in readers:
+            reader.start()
+        for _ in range(messages):
+            for client in conns:
+                client.send("x" * 100)
+        for reader in readers:
+            reader.join()
+        elapsed = time.perf_counter() - start
+        print(f"{workers} workers: {expected} deliveries in {elapsed:.2f} s, {expected/elapsed:.0f} messages/s")
+        for client in conns:
+            client.close()
+        server.send_signal(signal.SIGINT)
+        server.wait()
+        port += 1
+
+
+if __name__ == "__main__":
+    if '--bench' in sys.argv:
+        benchmark()
+    else:
+        workers = int(sys.argv[sys.argv.index('-w') + 1]) if '-w' in sys.argv else WORKERS
+        port = int(sys.argv[sys.argv.index('-p') + 1]) if '-p' in sys.argv else ser_async.server_sock[1]
+        main(workers, (ser_async.server_sock[0], port))
@@ -0,0 +1,263 @@
+'''
+    Session resumption, opt-in (-r flag of ser.py and cl.py).
+    After key exchange both sides derive resumption secret from the session key.
+    Server keeps it under random ticket id and sends the id to client.
+
+    Client hello, first frame of every connection:
+        b''                                - no ticket, full RSA/BB84 exchange follows
+        ticket | client_nonce | proof      - resume
+    Server answer:
+        b''                                - full exchange
+        server_nonce | new_ticket          - resumed, new session key is
+                                             shake_256(secret | client_nonce | server_nonce)
+    After full exchange server sends frame with new ticket.
+    Tickets are single-use: each resume replaces the ticket with a new one
+'''
+
+import hmac
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from AES_lib import AES_KEY_LEN
+from client import send_frame
+from keccak import shake_256, sha3_256
+
+TICKET_LEN = 16
+NONCE_LEN = 16
+PROOF_LEN = 16
+TICKET_TTL = 3600      # seconds a ticket may be used after it was issued
+TICKET_CACHE_LEN = 10000
+
+
+def resumption_secret(key: bytes):
+    return shake_256(b"chat resumption" + bytes(key), AES_KEY_LEN)
+
+def _proof(secret: bytes, client_nonce: bytes):
+    return sha3_256(b"chat resume proof" + secret + client_nonce)[:PROOF_LEN]
+
+def _session_key(secret: bytes, client_nonce: bytes, server_nonce: bytes):
+    return shake_256(b"chat resume key" + secret + client_nonce + server_nonce, AES_KEY_LEN)
+
+
+class TicketCache:
+    '''
+        Server side: ticket -> (resumption secret, issue time), LRU with TTL, safe for use from many threads
+    '''
+    def __init__(self, max_len: int = TICKET_CACHE_LEN, ttl: float = TICKET_TTL):
+        self.max_len = max_len
+        self.ttl = ttl
+        self.tickets = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def issue(self, key: bytes):
+        '''
+            Store resumption secret of session key, return new ticket
+        '''
+        ticket = os.urandom(TICKET_LEN)
+        with self.lock:
+            self.tickets[ticket] = (resumption_secret(key), time.monotonic())
+            while len(self.tickets) > self.max_len:
+                self.tickets.popitem(last=False) # least recently issued
+        return ticket
+
+    def take(self, ticket: bytes, valid=lambda secret: True):
+        '''
+            Remove ticket and return its secret, None if it is unknown or expired.
+            valid - check of secret (proof of client), a ticket which fails it is kept,
+            so it can't be burnt by anyone who has seen it
+        '''
+        with self.lock:
+            entry = self.tickets.get(ticket)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl:
+                del self.tickets[ticket]
+                entry = None
+            if entry is None or not valid(entry[0]):
+                self.misses += 1
+                return None
+            del self.tickets[ticket]
+            self.hits += 1
+            return entry[0]
+
+    def __len__(self):
+        return len(self.tickets)
+
+
+def server_resume(sock, reader, cache: TicketCache):
+    '''
+        Read client hello. Return session key if the client is resumed,
+        otherwise None: full key exchange must follow, then server_issue
+    '''
+    hello = bytes(reader.read_frame())
+    if len(hello) == TICKET_LEN + NONCE_LEN + PROOF_LEN:
+        ticket, client_nonce, proof = hello[:TICKET_LEN], hello[TICKET_LEN:-PROOF_LEN], hello[-PROOF_LEN:]
+        secret = cache.take(ticket, lambda secret: hmac.compare_digest(proof, _proof(secret, client_nonce)))
+        if secret is not None:
+            server_nonce = os.urandom(NONCE_LEN)
+            key = _session_key(secret, client_nonce, server_nonce)
+            send_frame(sock, server_nonce + cache.issue(key))
+            return key
+    send_frame(sock, b"")
+    return None
+
+def server_issue(sock, key, cache: TicketCache):
+    '''
+        Send ticket for session key after full key exchange
+    '''
+    send_frame(sock, cache.issue(bytes(key)))
+
+
+class TicketStore:
+    '''
+        Client side: ticket and resumption secret, kept in file so a restarted client can resume
+    '''
+    def __init__(self, path: str = None):
+        self.path = path
+        self.ticket = self.secret = None
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                fields = f.read().split()
+            if len(fields) == 2:
+                self.ticket, self.secret = map(bytes.fromhex, fields)
+
+    def set(self, ticket: bytes, key: bytes):
+        self.ticket, self.secret = ticket, resumption_secret(key)
+        if self.path is not None:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{self.ticket.hex()} {self.secret.hex()}\n")
+
+    def clear(self):
+        self.ticket = self.secret = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def client_resume(sock, reader, store: TicketStore):
+    '''
+        Send hello. Return session key if server resumed the session,
+        otherwise None: full key exchange must follow, then client_store
+    '''
+    if store.ticket is None:
+        send_frame(sock, b"")
+    else:
+        client_nonce = os.urandom(NONCE_LEN)
+        send_frame(sock, store.ticket + client_nonce + _proof(store.secret, client_nonce))
+    answer = bytes(reader.read_frame())
+    if store.ticket is None or len(answer) != NONCE_LEN + TICKET_LEN:
+        store.clear() # used or unknown to server
+        return None
+    key = _session_key(store.secret, client_nonce, answer[:NONCE_LEN])
+    store.set(answer[NONCE_LEN:], key)
+    return key
+
+def client_store(reader, key, store: TicketStore):
+    '''
+        Receive ticket after full key exchange
+    '''
+    store.set(bytes(reader.read_frame()), bytes(key))
+
+
+def benchmark(count: int = 20):
+    '''
+        Reconnect time: full RSA exchange against resume
+    '''
+    import socket
+    from AES_lib import gen_key
+    from client import Client, FrameReader
+    cache = TicketCache()
+    store = TicketStore()
+    def server(sock):
+        reader = FrameReader(sock)
+        key = server_resume(sock, reader, cache)
+        if key is None:
+            client = Client(gen_key(), sock, reader)
+            client.key_exchange()
+            server_issue(sock, client.key, cache)
+    for name in ("full", "resume"):
+        total = 0
+        for _ in range(count):
+            if name == "full":
+                store.clear()
+            a, b = socket.socketpair()
+            thread = threading.Thread(target=server, args=(a,))
+            thread.start()
+            start = time.perf_counter()
+            reader = FrameReader(b)
+            if client_resume(b, reader, store) is None:
+                client_store(reader, Client.get_key(b, reader), store)
+            total += time.perf_counter() - start
+            thread.join()
+            a.close()
+            b.close()
+        print(f"{name:>6}: {total/count*1000:8.3f} ms per reconnect")
+
+
+def tests():
+    import socket, tempfile
+    from AES_lib import gen_key
+    from client import Client, FrameReader
+    cache = TicketCache(max_len=2)
+    path = os.path.join(tempfile.mkdtemp(), "session.ticket")
+
+    def connect(store):
+        a, b = socket.socketpair()
+        res = {}
+        def server():
+            reader = FrameReader(a)
+            key = server_resume(a, reader, cache)
+            res["resumed"] = key is not None
+            if key is None:
+                client = Client(gen_key(), a, reader)
+                client.key_exchange()
+                server_issue(a, client.key, cache)
+                key = client.key
+            res["key"] = bytes(key)
+        thread = threading.Thread(target=server)
+        thread.start()
+        reader = FrameReader(b)
+        key = client_resume(b, reader, store)
+        if key is None:
+            key = Client.get_key(b, reader)
+            client_store(reader, key, store)
+        thread.join()
+        a.close()
+        b.close()
+        assert bytes(key) == res["key"]
+        return res["resumed"]
+
+    assert not connect(TicketStore(path))
+    assert connect(TicketStore(path)) # restarted client resumes from file
+    store = TicketStore(path)
+    old_ticket = store.ticket
+    # wrong proof doesn't burn the ticket of the client
+    forged = TicketStore()
+    forged.ticket, forged.secret = store.ticket, resumption_secret(b"x" * AES_KEY_LEN)
+    assert not connect(forged)
+    assert connect(store) and store.ticket != old_ticket
+    # ticket is single-use: replayed one gives full exchange
+    store.ticket, store.secret = old_ticket, resumption_secret(b"x" * AES_KEY_LEN)
+    assert not connect(store)
+    # LRU bound and TTL
+    for _ in range(3):
+        cache.issue(b"k" * AES_KEY_LEN)
+    assert len(cache) == 2
+    cache.ttl = 0
+    assert not connect(store)
+    # client without ticket is not resumed, whatever server answers
+    a, b = socket.socketpair()
+    send_frame(a, os.urandom(NONCE_LEN + TICKET_LEN))
+    assert client_resume(b, FrameReader(b), TicketStore()) is None
+    a.close()
+    b.close()
+    print("Tests passed successfully")
+
+if __name__ == "__main__":
+    import sys
+    tests()
+    if '--bench' in sys.argv:
+        benchmark()